@@ -1,4 +1,4 @@
-import hits.utilities
+from functools import cached_property as memoized_property
 
 from hits import sam, interval
 
@@ -6,8 +6,6 @@ import knock_knock.layout
 import knock_knock.twin_prime_layout
 from knock_knock.outcome import *
 
-memoized_property = hits.utilities.memoized_property
-
 class Layout(knock_knock.twin_prime_layout.Layout):
     category_order = [
         ('wild type',
@@ -1,16 +1,239 @@
 import contextlib
+import gzip
+import itertools
+import os
+import queue
 import shlex
+import shutil
 import subprocess
 import tempfile
+import threading
 from pathlib import Path
 
 import pysam
 
-from hits import sam, fasta, fastq
+from hits import sam, fasta, utilities
 
 HARD_CLIP = sam.BAM_CHARD_CLIP
 SOFT_CLIP = sam.BAM_CSOFT_CLIP
 
+# Default memory per samtools sort thread, large enough that a sort keeps
+# everything in memory rather than spilling to temporary files.
+SORT_MEMORY_PER_THREAD = '1G'
+
+FASTQ_BUFFER_SIZE = 1 << 17
+
+# Reads are written to blastn's stdin in many small records; a large buffer
+# turns these into few large pipe writes.
+FASTA_BUFFER_SIZE = 1 << 20
+
+# tmpfs on Linux, so intermediate files never touch disk.
+SHM_DIR = '/dev/shm'
+
+# Don't claim more than this fraction of free space in SHM_DIR.
+SHM_MAX_FRACTION = 0.5
+
+# Rough upper bound on fastq gzip compression ratio, for size estimates.
+GZIP_EXPANSION = 5
+
+# Generous number of alignments per read (including pieces produced by
+# splitting at large insertions), for size estimates.
+ESTIMATED_ALIGNMENTS_PER_READ = 5
+
+# Fixed-length fields, cigar, and tags of one uncompressed bam record, for
+# size estimates.
+ALIGNMENT_OVERHEAD_BYTES = 100
+
+# Marks the end of one reader thread's output on the shared alignment queue.
+_READER_DONE = object()
+
+@contextlib.contextmanager
+def _killing_on_error(processes, cleanup=None):
+    ''' Don't leave processes (and a writer thread blocked on their stdin)
+    running if consuming their output fails. cleanup, if given, is called
+    after the processes are dead, to release any threads still blocked on
+    their output.
+    '''
+    try:
+        yield
+    except BaseException:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+        if cleanup is not None:
+            cleanup()
+
+        raise
+
+def fastq_records(fns):
+    ''' Yield (name, seq, qual) tuples of bytes from the fastq file(s) fns,
+    with names truncated at the first space. Lines are split by the buffered
+    binary reader in C, and no hits.fastq.Read objects are constructed.
+    Raises ValueError on a malformed or truncated record rather than
+    silently dropping it.
+    '''
+    if isinstance(fns, (str, Path)):
+        fns = [fns]
+
+    for fn in fns:
+        fn = Path(fn)
+
+        if fn.suffix == '.gz':
+            fh = gzip.open(fn, 'rb')
+        else:
+            fh = fn.open('rb', buffering=FASTQ_BUFFER_SIZE)
+
+        with fh:
+            lines = itertools.zip_longest(fh, fh, fh, fh)
+            for record_i, (name_line, seq_line, plus_line, qual_line) in enumerate(lines):
+                if qual_line is None:
+                    raise ValueError(f'{fn}: record {record_i} is truncated')
+
+                if not name_line.startswith(b'@') or not plus_line.startswith(b'+'):
+                    raise ValueError(f'{fn}: record {record_i} is malformed: {name_line!r}')
+
+                name_fields = name_line[1:].split(maxsplit=1)
+                if not name_fields:
+                    raise ValueError(f'{fn}: record {record_i} has an empty name')
+
+                yield name_fields[0], seq_line.rstrip(), qual_line.rstrip()
+
+def records_with_seqs(records, reads_by_name):
+    ''' Pass on bytes (name, seq, qual) records that have a sequence. Records
+    without one can't be given to blastn, so they are only recorded in
+    reads_by_name, to be reported as unaligned.
+    '''
+    for name, seq, qual in records:
+        if seq:
+            yield name, seq, qual
+        else:
+            reads_by_name[name.decode()] = (seq, qual)
+
+def write_reads_as_fasta(records, reads_by_name, fhs, exceptions):
+    ''' Record each bytes (name, seq, qual) in reads_by_name, then write it as
+    fasta to one of fhs (blastn processes' stdins), distributing records
+    round-robin. Every record must have a non-empty seq. Intended to run on
+    its own thread; any exception is stored in exceptions for the consuming
+    thread to re-raise.
+    '''
+    try:
+        for (name, seq, qual), fh in zip(records, itertools.cycle(fhs)):
+            # Record before writing so that the read is always known by the
+            # time blastn can report an alignment to it.
+            # Keyed by str to match pysam's query_name. Only the raw bytes
+            # are kept, not any Read object.
+            reads_by_name[name.decode()] = (seq, qual)
+
+            # Format is fixed, so skip building a fasta.Read per record.
+            fh.write(b'>%b\n%b\n' % (name, seq))
+
+    except BrokenPipeError:
+        # A blastn exited early. Return codes are checked by the caller.
+        pass
+
+    except Exception as e:
+        exceptions.append(e)
+
+    finally:
+        for fh in fhs:
+            try:
+                fh.close()
+            except BrokenPipeError:
+                pass
+
+def queue_alignments(sam_stream, alignment_queue, batch_size=1000):
+    ''' Parse SAM output from sam_stream, putting its header and then batches
+    of alignments onto alignment_queue, followed by _READER_DONE. Intended to
+    run on its own thread; pysam releases the GIL while blocked on the stream.
+    '''
+    try:
+        try:
+            sam_fh = pysam.AlignmentFile(sam_stream)
+        except ValueError:
+            # blast had no output
+            return
+
+        with sam_fh:
+            alignment_queue.put(sam_fh.header)
+
+            batch = []
+            for al in sam_fh:
+                batch.append(al)
+                if len(batch) == batch_size:
+                    alignment_queue.put(batch)
+                    batch = []
+
+            if batch:
+                alignment_queue.put(batch)
+
+    except Exception as e:
+        alignment_queue.put(e)
+
+    finally:
+        alignment_queue.put(_READER_DONE)
+
+def memory_backed_temp_dir_if_room(reads, concurrent_jobs=1):
+    ''' Return /dev/shm if it exists and reads' intermediate files should
+    comfortably fit in it, otherwise None (the default temp location).
+    Only reads whose size is known up front (fastq paths or lists of Reads)
+    are considered. concurrent_jobs is the number of blast() calls that may
+    be sharing /dev/shm at once, each of which only gets its share.
+    '''
+    if not os.path.isdir(SHM_DIR):
+        return None
+
+    if isinstance(reads, (str, Path)):
+        reads = [reads]
+
+    if not isinstance(reads, list):
+        return None
+
+    if len(reads) > 0 and isinstance(reads[0], (str, Path)):
+        # The record count isn't known without reading the files, so per-record
+        # bam overhead is left out here. This is only an approximation for
+        # direct callers; Experiment always passes Reads.
+        input_size = 0
+        for fn in reads:
+            fn = Path(fn)
+            input_size += fn.stat().st_size * (GZIP_EXPANSION if fn.suffix == '.gz' else 1)
+    else:
+        input_size = sum(len(read.name) + 2 * len(read.seq) + ALIGNMENT_OVERHEAD_BYTES for read in reads)
+
+    # Everything is written uncompressed, and each alignment carries a full
+    # copy of its read.
+    aligned = ESTIMATED_ALIGNMENTS_PER_READ
+    copies_per_read = (aligned # unsorted aligned bam
+                       + 1 # unaligned bam
+                       + (aligned + 1) # their concatenation
+                       + aligned + (aligned + 1) # samtools sort temporary files, if either sort spills
+                      )
+    estimated_size = copies_per_read * input_size
+
+    available = shutil.disk_usage(SHM_DIR).free * SHM_MAX_FRACTION / max(concurrent_jobs, 1)
+
+    if estimated_size < available:
+        return SHM_DIR
+    else:
+        return None
+
+def write_batches(batch_queue, fh, exceptions):
+    ''' Write lists of alignments from batch_queue to fh until None is
+    received. Intended to run on its own thread; pysam releases the GIL
+    while encoding. On error, keeps draining batch_queue so that the
+    producer can't block, and stores the exception in exceptions.
+    '''
+    try:
+        while (batch := batch_queue.get()) is not None:
+            for al in batch:
+                fh.write(al)
+
+    except Exception as e:
+        exceptions.append(e)
+
+        while batch_queue.get() is not None:
+            pass
+
 def blast(ref_fn,
           reads,
           bam_fn=None,
@@ -18,48 +241,64 @@ def blast(ref_fn,
           max_insertion_length=None,
           manual_temp_dir=None,
           return_alignments=False,
+          num_threads=1,
+          sort_threads=1,
+          sort_memory=SORT_MEMORY_PER_THREAD,
+          concurrent_jobs=1,
          ):
     ''' ref_fn: either a path to a fasta file, or a dictionary of reference sequences
         reads: either a path to a fastq/fastq.gz file, or a list of such paths, or an iterator over hits.fastq.Read objects
         bam_fn: path to write reference coordinate-sorted alignments
         bam_by_name_fn: path to write query name-sorted alignments
         max_insertion_length: If not None, any alignments with insertions longer than max_insertion_length will be split into multiple alignments.
+        num_threads: number of blastn processes to shard reads across
+        sort_threads: number of threads for samtools sort to use when producing bam_fn and bam_by_name_fn
+        sort_memory: memory per sort thread, in samtools sort's -m format
+        concurrent_jobs: number of blast calls that may be running at once, for deciding whether intermediate files fit in memory
     '''
+    if manual_temp_dir is None:
+        manual_temp_dir = memory_backed_temp_dir_if_room(reads, concurrent_jobs)
+
     with tempfile.TemporaryDirectory(suffix='_blast', dir=manual_temp_dir) as temp_dir:
         temp_dir_path = Path(temp_dir)
 
+        ref_seqs = None
+
         if isinstance(ref_fn, dict):
+            ref_seqs = ref_fn
+
             # Make a temporary ref file.
             temp_ref_fn = temp_dir_path / 'refs.fasta'
             fasta.write_dict(ref_fn, temp_ref_fn)
             ref_fn = temp_ref_fn
 
-        reads_fasta_fn = temp_dir_path / 'reads.fasta'
+        # Only forward-strand reads are retained. Reverse complements are
+        # computed on demand for the (typically few) reads that have
+        # minus-strand alignments.
+        reads_by_name = {}
 
-        sam_fn = temp_dir_path / 'alignments.sam'
+        num_threads = max(num_threads, 1)
 
-        fastq_dict = {
-            '+': {},
-            '-': {},
-        }
-
-        if isinstance(reads, list) and isinstance(reads[0], fastq.Read):
-            # Need to exempt lists of Reads from being passed to fastq.reads below
-            pass
-        elif isinstance(reads, (str, Path, list)):
-            reads = fastq.reads(reads, up_to_space=True)
+        if isinstance(reads, (str, Path)):
+            records = fastq_records(reads)
+        elif isinstance(reads, list) and len(reads) > 0 and isinstance(reads[0], (str, Path)):
+            records = fastq_records(reads)
+        else:
+            # Any other iterable is assumed to be over Reads and is consumed
+            # lazily, exactly once, by the writer thread.
+            records = ((read.name.encode(), read.seq.encode(), read.qual.encode()) for read in reads)
 
-        with reads_fasta_fn.open('w') as fasta_fh:
-            for read in reads:
-                fastq_dict['+'][read.name] = read
-                fastq_dict['-'][read.name] = read.reverse_complement()
+        # Only records that will actually be written are counted and
+        # distributed across processes.
+        records = records_with_seqs(records, reads_by_name)
 
-                if len(read) > 0:
-                    fasta_read = fasta.Read(read.name, read.seq)
-                    fasta_fh.write(str(fasta_read))
+        # No more processes than reads, so that no blastn is started with
+        # empty input. Peeking keeps iterators lazy. No reads at all means no
+        # blastn is run and empty outputs are produced.
+        first_records = list(itertools.islice(records, num_threads))
+        num_threads = len(first_records)
+        records = itertools.chain(first_records, records)
 
-        pysam.faidx(str(reads_fasta_fn))
-            
         blast_command = [
             'blastn',
             '-task', 'blastn', # default is megablast
@@ -69,89 +308,246 @@ def blast(ref_fn,
             '-max_target_seqs', '1000000',
             '-parse_deflines', # otherwise qnames/rnames are lost
             '-outfmt', '17', # SAM output
-            '-subject', str(reads_fasta_fn), # for bowtie-like behavior, reads are subject ...
+            '-subject', '-', # for bowtie-like behavior, reads are subject (streamed on stdin) ...
             '-query', str(ref_fn), # ... and refs are query
-            '-out', str(sam_fn),
+            '-out', '-',
         ]
 
-        try:
-            subprocess.run(blast_command,
-                           check=True,
-                           stderr=subprocess.PIPE,
-                           stdout=subprocess.PIPE,
-                          )
-        except subprocess.CalledProcessError as e:
-            print(f'blastn command returned code {e.returncode}')
-            print(f'full command was:\n\n{shlex.join(blast_command)}\n')
-            print(f'stdout from blastn was:\n\n{e.stdout.decode()}\n')
-            print(f'stderr from blastn was:\n\n{e.stderr.decode()}\n')
-            raise
+        # blastn ignores -num_threads when given -subject, so parallelism
+        # comes from sharding reads across independent processes instead.
+        # stderr goes to files so that a chatty blastn can't fill a pipe
+        # nobody is draining and deadlock against the stdin writer.
+        stderr_fns = [temp_dir_path / f'blastn_stderr.{i}.txt' for i in range(num_threads)]
+
+        blast_processes = []
+        for stderr_fn in stderr_fns:
+            with stderr_fn.open('wb') as stderr_fh:
+                blast_process = subprocess.Popen(blast_command,
+                                                 stdin=subprocess.PIPE,
+                                                 stdout=subprocess.PIPE,
+                                                 stderr=stderr_fh,
+                                                 bufsize=FASTA_BUFFER_SIZE,
+                                                )
+            blast_processes.append(blast_process)
+
+        writer_exceptions = []
+        writer_thread = threading.Thread(target=write_reads_as_fasta,
+                                         args=(records, reads_by_name, [p.stdin for p in blast_processes], writer_exceptions),
+                                         daemon=True,
+                                        )
+
+        # Bounded so that readers can't run arbitrarily far ahead of the
+        # consumer. Readers block on put, which backs up into blastn, which
+        # backs up into the writer.
+        alignment_queue = queue.Queue(maxsize=64)
+        reader_threads = [
+            threading.Thread(target=queue_alignments,
+                             args=(p.stdout, alignment_queue),
+                             daemon=True,
+                            )
+            for p in blast_processes
+        ]
+
+        writer_thread.start()
+        for reader_thread in reader_threads:
+            reader_thread.start()
+
+        def wait_for_blast():
+            writer_thread.join()
+
+            for reader_thread in reader_threads:
+                reader_thread.join()
+
+            if writer_exceptions:
+                raise writer_exceptions[0]
+
+            for blast_process, stderr_fn in zip(blast_processes, stderr_fns):
+                blast_process.stdout.close()
+                returncode = blast_process.wait()
+
+                if returncode != 0:
+                    print(f'blastn command returned code {returncode}')
+                    print(f'full command was:\n\n{shlex.join(blast_command)}\n')
+                    print(f'stderr from blastn was:\n\n{stderr_fn.read_text()}\n')
+                    raise subprocess.CalledProcessError(returncode, blast_command)
+
+        readers_remaining = len(reader_threads)
+
+        def next_from_queue():
+            nonlocal readers_remaining
+
+            while readers_remaining > 0:
+                item = alignment_queue.get()
+
+                if item is _READER_DONE:
+                    readers_remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    return item
+
+            return None
+
+        def discard_queued_alignments():
+            ''' Killing blastn ends the readers' input, but a reader may still
+            be blocked putting onto a full alignment_queue, so keep taking
+            items until every reader has finished.
+            '''
+            nonlocal readers_remaining
+
+            while readers_remaining > 0:
+                if alignment_queue.get() is _READER_DONE:
+                    readers_remaining -= 1
+
+            for reader_thread in reader_threads:
+                reader_thread.join()
+
+            writer_thread.join()
+
+        def queued_batches():
+            while (batch := next_from_queue()) is not None:
+                if isinstance(batch, pysam.AlignmentHeader):
+                    # All shards share the same header.
+                    continue
+
+                yield batch
 
         def undo_hard_clipping(al):
-            strand = sam.get_strand(al)
-            read = fastq_dict[strand][al.query_name]
+            seq, qual = reads_by_name[al.query_name]
+
+            qualities = pysam.qualitystring_to_array(qual)
 
-            al.query_sequence = read.seq
-            al.query_qualities = read.query_qualities
+            if al.is_reverse:
+                seq = utilities.reverse_complement(seq)
+                qualities = qualities[::-1]
 
-            al.cigar = [(SOFT_CLIP if k == HARD_CLIP else k, l) for k, l in al.cigar]
-    
-        def make_unaligned(read):
+            al.query_sequence = seq
+            al.query_qualities = qualities
+
+            # Hard clips can only be the first or last op, so most
+            # alignments can be recognized as needing no rewrite without
+            # walking the whole CIGAR.
+            cigar = al.cigartuples
+            if cigar[0][0] == HARD_CLIP or cigar[-1][0] == HARD_CLIP:
+                al.cigartuples = [(SOFT_CLIP, l) if k == HARD_CLIP else (k, l) for k, l in cigar]
+
+        def make_unaligned(name, seq, qual):
             unal = pysam.AlignedSegment()
-            unal.query_name = read.name
+            unal.query_name = name
             unal.is_unmapped = True
-            unal.query_sequence = read.seq
-            unal.query_qualities = read.query_qualities
+            unal.query_sequence = seq
+            unal.query_qualities = pysam.qualitystring_to_array(qual)
             return unal
 
-        try:
-            sam_fh = pysam.AlignmentFile(str(sam_fn))
-            header = sam_fh.header
-        except ValueError:
+        with _killing_on_error(blast_processes, discard_queued_alignments):
+            # Each reader puts its header before any of its alignments, so
+            # the first item to arrive from any reader is a header.
+            header = next_from_queue()
+
+        if header is None:
             # blast had no output
-            header = sam.header_from_fasta(ref_fn)
-            pysam.AlignmentFile(str(sam_fn), 'wb', header=header).close()
-            sam_fh = pysam.AlignmentFile(str(sam_fn))
+            if ref_seqs is not None:
+                # No need to re-parse the fasta that was just written.
+                header = pysam.AlignmentHeader.from_references(list(ref_seqs),
+                                                               [len(seq) for seq in ref_seqs.values()],
+                                                              )
+            else:
+                header = sam.header_from_fasta(ref_fn)
 
-        if bam_fn is not None:
-            sorter = sam.AlignmentSorter(bam_fn, header)
+        # Aligned and unaligned records are each encoded exactly once, into
+        # temporary unsorted bams. The requested outputs are then produced by
+        # samtools sort runs that can be given threads and memory, which
+        # sam.AlignmentSorter doesn't expose.
+        write_bams = (bam_fn is not None or bam_by_name_fn is not None)
+
+        aligned_bam_fn = temp_dir_path / 'aligned.unsorted.bam'
+        unaligned_bam_fn = temp_dir_path / 'unaligned.unsorted.bam'
+
+        if write_bams:
+            aligned_fh = pysam.AlignmentFile(str(aligned_bam_fn), 'wbu', header=header)
         else:
-            sorter = contextlib.nullcontext()
+            aligned_fh = contextlib.nullcontext()
 
         if bam_by_name_fn is not None:
-            by_name_sorter = sam.AlignmentSorter(bam_by_name_fn, header, by_name=True)
+            unaligned_fh = pysam.AlignmentFile(str(unaligned_bam_fn), 'wbu', header=header)
         else:
-            by_name_sorter = contextlib.nullcontext()
+            unaligned_fh = contextlib.nullcontext()
 
         alignments = []
 
-        with sorter, by_name_sorter:
+        with aligned_fh, unaligned_fh, _killing_on_error(blast_processes, discard_queued_alignments):
+            # Processed batches are handed to a separate thread for bam
+            # encoding, which overlaps with processing of the next batch.
+            bam_queue = queue.Queue(maxsize=16)
+            bam_writer_exceptions = []
+            bam_writer_thread = threading.Thread(target=write_batches,
+                                                 args=(bam_queue, aligned_fh, bam_writer_exceptions),
+                                                 daemon=True,
+                                                )
+            if write_bams:
+                bam_writer_thread.start()
+
             aligned_names = set()
-            for al in sam_fh:
-                aligned_names.add(al.query_name)
+            add_aligned_name = aligned_names.add
 
-                undo_hard_clipping(al)
+            try:
+                for batch in queued_batches():
+                    processed = []
 
-                if max_insertion_length is not None:
-                    split_als = sam.split_at_large_insertions(al, max_insertion_length + 1)
-                else:
-                    split_als = [al]
+                    for al in batch:
+                        add_aligned_name(al.query_name)
 
-                for split_al in split_als:
-                    if bam_fn is not None:
-                        sorter.write(split_al)
-                    if bam_by_name_fn is not None:
-                        by_name_sorter.write(split_al)
+                        undo_hard_clipping(al)
 
-                    if return_alignments:
-                        alignments.append(split_al)
+                        if max_insertion_length is not None:
+                            processed.extend(sam.split_at_large_insertions(al, max_insertion_length + 1))
+                        else:
+                            processed.append(al)
+
+                    if write_bams:
+                        bam_queue.put(processed)
 
-            for name in fastq_dict['+']:
-                if name not in aligned_names:
-                    unal = make_unaligned(fastq_dict['+'][name])
-                    if bam_by_name_fn is not None:
-                        by_name_sorter.write(unal)
                     if return_alignments:
-                        alignments.append(unal)
+                        alignments.extend(processed)
+
+            finally:
+                if write_bams:
+                    bam_queue.put(None)
+                    bam_writer_thread.join()
+
+            if bam_writer_exceptions:
+                raise bam_writer_exceptions[0]
+
+            # Also guarantees that reads_by_name is complete.
+            wait_for_blast()
+
+            # One C-level set difference instead of a Python-level
+            # membership test for every read.
+            for name in reads_by_name.keys() - aligned_names:
+                unal = make_unaligned(name, *reads_by_name[name])
+                if bam_by_name_fn is not None:
+                    unaligned_fh.write(unal)
+                if return_alignments:
+                    alignments.append(unal)
+
+        sort_options = ['-@', str(sort_threads), '-m', sort_memory]
+
+        if bam_fn is not None:
+            pysam.sort(*sort_options,
+                       '-T', str(temp_dir_path / 'sort'),
+                       '-o', str(bam_fn),
+                       str(aligned_bam_fn),
+                      )
+            pysam.index(str(bam_fn))
+
+        if bam_by_name_fn is not None:
+            combined_bam_fn = temp_dir_path / 'combined.unsorted.bam'
+            pysam.cat('-o', str(combined_bam_fn), str(aligned_bam_fn), str(unaligned_bam_fn))
+            pysam.sort('-n',
+                       *sort_options,
+                       '-T', str(temp_dir_path / 'by_name_sort'),
+                       '-o', str(bam_by_name_fn),
+                       str(combined_bam_fn),
+                      )
 
         return alignments
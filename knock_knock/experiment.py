@@ -93,6 +93,17 @@ class Experiment:
 
         self.max_insertion_length = 20
 
+        # blastn processes to shard reads across, and threads and per-thread
+        # memory for samtools sort when producing alignment bams. Overridden
+        # from the command line.
+        self.blast_processes = 1
+        self.sort_threads = 1
+        self.sort_memory = blast.SORT_MEMORY_PER_THREAD
+
+        # Number of experiments that may be aligning at the same time, which
+        # share any memory-backed temporary space.
+        self.concurrent_jobs = 1
+
         self.sgRNAs = self.description.get('sgRNAs')
         self.donor = self.description.get('donor')
         self.nonhomologous_donor = self.description.get('nonhomologous_donor')
@@ -397,6 +408,10 @@ class Experiment:
         base_bam_by_name_fn = self.fns_by_read_type['primary_bam_by_name'][read_type]
 
         for i, chunk in enumerate(utilities.chunks(reads, 10000)):
+            # Materialized so that blast can size its intermediate files up
+            # front and decide whether they fit in memory.
+            chunk = list(chunk)
+
             suffix = f'.{i:06d}.bam'
             bam_fn = base_bam_fn.with_suffix(suffix)
             bam_by_name_fn = base_bam_by_name_fn.with_suffix(suffix)
@@ -406,6 +421,10 @@ class Experiment:
                         bam_fn,
                         bam_by_name_fn,
                         max_insertion_length=self.max_insertion_length,
+                        num_threads=self.blast_processes,
+                        sort_threads=self.sort_threads,
+                        sort_memory=self.sort_memory,
+                        concurrent_jobs=self.concurrent_jobs,
                        )
 
             bam_fns.append(bam_fn)
@@ -1052,7 +1071,17 @@ class Experiment:
 
         y_maxes = []
 
-        listed_order = sorted(outcome_lengths, key=self.categorizer.order)
+        # Outcomes missing from the precomputed table fall back to order(), which
+        # raises a descriptive error for genuinely unknown outcomes.
+        order_by_outcome = self.categorizer.order_by_outcome()
+
+        def outcome_order(outcome):
+            order = order_by_outcome.get(outcome)
+            if order is None:
+                order = self.categorizer.order(outcome)
+            return order
+
+        listed_order = sorted(outcome_lengths, key=outcome_order)
 
         non_highlight_color = 'grey'
 
@@ -1627,6 +1656,10 @@ def process_experiment_stage(base_dir,
                              stage,
                              progress=None,
                              print_timestamps=False,
+                             blast_processes=1,
+                             sort_threads=1,
+                             sort_memory=blast.SORT_MEMORY_PER_THREAD,
+                             concurrent_jobs=1,
                             ):
     sample_sheet = load_sample_sheet(base_dir, batch_name)
 
@@ -1641,6 +1674,10 @@ def process_experiment_stage(base_dir,
 
     exp_class = get_exp_class(description.get('platform'))
     exp = exp_class(base_dir, batch_name, sample_name, description=description, progress=progress)
+    exp.blast_processes = blast_processes
+    exp.sort_threads = sort_threads
+    exp.sort_memory = sort_memory
+    exp.concurrent_jobs = concurrent_jobs
 
     if print_timestamps:
         print(f'{utilities.current_time_string()} Started {batch_name}: {sample_name} {stage}')
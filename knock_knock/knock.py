@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import logging
 import multiprocessing
 import os
@@ -14,11 +15,20 @@ import yaml
 import tqdm
 
 import knock_knock
+import knock_knock.blast
 import knock_knock.build_targets
 import knock_knock.experiment
 import knock_knock.table
 
+@functools.lru_cache(maxsize=None)
 def check_blastn(require_precise_version=False):
+    ''' Memoized so that blastn is only launched once per invocation.
+    Setting KNOCK_KNOCK_SKIP_BLASTN_CHECK skips the check entirely, for
+    pipelines that have already validated their environment.
+    '''
+    if os.environ.get('KNOCK_KNOCK_SKIP_BLASTN_CHECK'):
+        return
+
     try:
         output = subprocess.check_output(['blastn', '-version'])
         if require_precise_version and b'2.7.1' not in output:
@@ -28,9 +38,20 @@ def check_blastn(require_precise_version=False):
         print('blastn is required and couldn\'t be found')
         sys.exit(1)
 
+def available_cpu_count():
+    ''' Number of CPUs this process may actually run on, respecting
+    affinity masks (e.g. from slurm) where the platform exposes them.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    else:
+        return os.cpu_count()
+
 def parallel(args):
     check_blastn()
 
+    max_procs = min(args.max_procs, available_cpu_count())
+
     if args.group:
         args.conditions['batch'] = args.group
 
@@ -41,19 +62,22 @@ def parallel(args):
         print(args.conditions)
         sys.exit(1)
 
-    def process_stage(stage):
-        with multiprocessing.Pool(processes=args.max_procs, maxtasksperchild=1) as process_pool:
+    stages = args.stages.split(',')
+
+    # One pool is shared by all stages so that workers (and their heavy
+    # imports) are reused. Workers are still recycled periodically to bound
+    # memory growth from long-lived experiment objects.
+    with multiprocessing.Pool(processes=max_procs, maxtasksperchild=16) as process_pool:
+        for stage in stages:
             arg_tuples = []
 
             for _, exp in exps.items():
-                arg_tuple = (exp.base_dir, exp.batch, exp.sample_name, stage, args.progress, True)
+                arg_tuple = (exp.base_dir, exp.batch, exp.sample_name, stage, args.progress, True, args.blast_processes, args.sort_threads, args.sort_memory, max_procs)
                 arg_tuples.append(arg_tuple)
 
-            process_pool.starmap(knock_knock.experiment.process_experiment_stage, arg_tuples)
-
-    stages = args.stages.split(',')
-    for stage in stages:
-        process_stage(stage)
+            # starmap blocks until the stage is finished for every experiment,
+            # since later stages depend on earlier ones.
+            process_pool.starmap(knock_knock.experiment.process_experiment_stage, arg_tuples, chunksize=1)
 
 def process(args):
     check_blastn()
@@ -67,6 +91,9 @@ def process(args):
                                                         stage,
                                                         progress=args.progress,
                                                         print_timestamps=True,
+                                                        blast_processes=args.blast_processes,
+                                                        sort_threads=args.sort_threads,
+                                                        sort_memory=args.sort_memory,
                                                        )
 
 def make_tables(args):
@@ -130,6 +157,31 @@ def build_indices(args):
                                                                 args.num_threads
                                                                )
 
+def copy_file_allowing_reflink(src, dst):
+    ''' copy_function for shutil.copytree. os.copy_file_range lets
+    copy-on-write filesystems (btrfs, XFS) clone the file instead of
+    copying its bytes. Falls back to shutil.copy2 where unavailable.
+    '''
+    if not hasattr(os, 'copy_file_range'):
+        return shutil.copy2(src, dst)
+
+    try:
+        with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+            remaining = os.fstat(src_fh.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src_fh.fileno(), dst_fh.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+
+    except OSError:
+        # e.g. EXDEV across filesystems on older kernels.
+        return shutil.copy2(src, dst)
+
+    shutil.copystat(src, dst)
+
+    return dst
+
 def install_example_data(args):
     package_dir = Path(os.path.realpath(knock_knock.__file__)).parent
     subdirs_to_copy = ['data', 'targets']
@@ -141,7 +193,7 @@ def install_example_data(args):
             print(f'Can\'t install to {args.project_directory}, {dest} already exists')
             sys.exit(1)
 
-        shutil.copytree(str(src), str(dest))
+        shutil.copytree(str(src), str(dest), copy_function=copy_file_allowing_reflink)
 
     logging.info(f'Example data installed in {args.project_directory}')
 
@@ -172,12 +224,18 @@ def main():
     def add_project_directory_arg(parser):
         parser.add_argument('project_directory', type=Path, help='the base directory to store input data, reference annotations, and analysis output for a project')
 
+    def add_alignment_args(parser):
+        parser.add_argument('--blast-processes', type=int, default=1, help='number of blastn processes to shard each chunk of reads across')
+        parser.add_argument('--sort-threads', type=int, default=1, help='number of threads for each samtools sort of alignments')
+        parser.add_argument('--sort-memory', default=knock_knock.blast.SORT_MEMORY_PER_THREAD, help='memory per samtools sort thread, e.g. 768M or 2G')
+
     parser_process = subparsers.add_parser('process', help='process a single sample')
     add_project_directory_arg(parser_process)
     parser_process.add_argument('group', help='group name')
     parser_process.add_argument('sample', help='sample name')
     parser_process.add_argument('--progress', const=tqdm.tqdm, action='store_const', help='show progress bars')
     parser_process.add_argument('--stages', default='preprocess,align,categorize,visualize')
+    add_alignment_args(parser_process)
     parser_process.set_defaults(func=process)
 
     parser_parallel = subparsers.add_parser('parallel', help='process multiple samples in parallel')
@@ -187,6 +245,7 @@ def main():
     parser_parallel.add_argument('--conditions', type=yaml.safe_load, default={}, help='if specified, conditions that samples must satisfy to be processed, given as yaml; if not specified, all samples will be processed')
     parser_parallel.add_argument('--stages', default='preprocess,align,categorize,visualize')
     parser_parallel.add_argument('--progress', const=tqdm.tqdm, action='store_const', help='show progress bars')
+    add_alignment_args(parser_parallel)
     parser_parallel.set_defaults(func=parallel)
 
     parser_table = subparsers.add_parser('table', help='generate tables of outcome frequencies')
@@ -218,7 +277,7 @@ def main():
     parser_indices = subparsers.add_parser('build-indices', help='download a reference genome and build alignment indices')
     add_project_directory_arg(parser_indices)
     parser_indices.add_argument('genome_name', help='name of genome to download')
-    parser_indices.add_argument('--num-threads', type=int, default=8, help='number of threads to use for index building')
+    parser_indices.add_argument('--num-threads', type=int, default=available_cpu_count(), help='number of threads to use for index building (default: all available CPUs)')
     parser_indices.set_defaults(func=build_indices)
 
     parser_install_data = subparsers.add_parser('install-example-data', help='install example data into user-specified project directory')
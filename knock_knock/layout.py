@@ -1,5 +1,10 @@
+import heapq
 import itertools
-import re
+import sys
+import types
+
+from collections import defaultdict, namedtuple
+from functools import cached_property as memoized_property, lru_cache, wraps
 
 import numpy as np
 import pandas as pd
@@ -12,10 +17,72 @@ from .outcome_record import Integration
 
 import knock_knock.outcome
 
-memoized_property = utilities.memoized_property
 memoized_with_args = utilities.memoized_with_args
 idx = pd.IndexSlice
 
+def memoized_per_class(f):
+    ''' classmethod whose value is computed once per class and stored in that
+    class's own __dict__. Unlike lru_cache, this doesn't keep classes alive,
+    and subclasses never see a parent's value. Values should be immutable,
+    since every caller shares them.
+    '''
+    attribute_name = f'_memoized_{f.__name__}'
+
+    @wraps(f)
+    def memoized_f(cls):
+        if attribute_name not in cls.__dict__:
+            setattr(cls, attribute_name, f(cls))
+
+        return cls.__dict__[attribute_name]
+
+    return classmethod(memoized_f)
+
+# Overall junction summary for each combination of (5' junction, 3' junction).
+# Any combination not listed is 'incomplete'.
+JUNCTION_SUMMARIES = {
+    ('HDR', 'HDR'): 'HDR',
+    ('blunt', 'HDR'): "5' blunt",
+    ('HDR', 'blunt'): "3' blunt",
+    ('blunt', 'blunt'): "5' and 3' blunt",
+}
+
+# Side of the read that each side of the target ends up on, keyed by (target side, read strand).
+READ_SIDE = {
+    (5, '+'): 'left',
+    (3, '+'): 'right',
+    (5, '-'): 'right',
+    (3, '-'): 'left',
+}
+
+class Sides(namedtuple('Sides', ['five', 'three'])):
+    ''' Immutable (5', 3') pair indexed by side like the {5: ..., 3: ...} dicts it stands in for. '''
+    __slots__ = ()
+
+    def __getitem__(self, side):
+        if side == 5:
+            return self.five
+        elif side == 3:
+            return self.three
+        else:
+            raise KeyError(side)
+
+    def get(self, side, default=None):
+        return self[side] if side in (5, 3) else default
+
+    def keys(self):
+        return (5, 3)
+
+    def values(self):
+        return (self.five, self.three)
+
+    def items(self):
+        return ((5, self.five), (3, self.three))
+
+SupplementalArrays = namedtuple('SupplementalArrays', ['starts', 'ends', 'query_alignment_lengths'])
+
+REF_CONSUMING_OPS = [pysam.CMATCH, pysam.CDEL, pysam.CREF_SKIP, pysam.CEQUAL, pysam.CDIFF]
+READ_CONSUMING_OPS = [pysam.CMATCH, pysam.CINS, pysam.CSOFT_CLIP, pysam.CEQUAL, pysam.CDIFF]
+
 class Categorizer:
     def __init__(self, alignments, target_info, **kwargs):
         self.alignments = alignments
@@ -29,6 +96,11 @@ class Categorizer:
 
         self.read = sam.mapping_to_Read(alignment)
 
+    @memoized_property
+    def seq_rc(self):
+        ''' Reverse complement of the read, computed once. '''
+        return utilities.reverse_complement(self.seq)
+
     @memoized_property
     def whole_read(self):
         return interval.Interval(0, len(self.seq) - 1)
@@ -44,56 +116,112 @@ class Categorizer:
 
         return full_index
 
-    @classmethod
+    @memoized_per_class
     def categories(cls):
-        return [c for c, scs in cls.category_order]
+        return tuple(c for c, scs in cls.category_order)
 
-    @classmethod
+    @memoized_per_class
     def subcategories(cls):
-        return dict(cls.category_order)
+        return types.MappingProxyType({c: tuple(scs) for c, scs in cls.category_order})
+
+    @memoized_per_class
+    def order_lookups(cls):
+        ''' Dictionaries from category to its index in category_order and from
+        category to subcategory to index, built once per class.
+        If a name is repeated, the first occurrence wins, matching list.index.
+        '''
+        category_index = {}
+        subcategory_index = {}
+        for i, (category, subcategories) in enumerate(cls.category_order):
+            category_index.setdefault(category, i)
+            subcategory_index.setdefault(category, {})
+            for j, subcategory in enumerate(subcategories):
+                subcategory_index[category].setdefault(subcategory, j)
+
+        subcategory_index = {category: types.MappingProxyType(index) for category, index in subcategory_index.items()}
+
+        return types.MappingProxyType(category_index), types.MappingProxyType(subcategory_index)
+
+    @classmethod
+    def order_pair(cls, outcome):
+        ''' order() for an outcome known to be a (category, subcategory) pair. '''
+        category_index, subcategory_index = cls.order_lookups()
+        category, subcategory = outcome
+
+        try:
+            return (category_index[category],
+                    subcategory_index[category][subcategory],
+                   )
+        except (KeyError, TypeError) as e:
+            raise ValueError(f'unknown outcome: {outcome!r}') from e
+
+    @classmethod
+    def order_single(cls, category):
+        ''' order() for an outcome known to be a bare category. '''
+        category_index, _ = cls.order_lookups()
+
+        try:
+            return category_index[category]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f'unknown category: {category!r}') from e
 
     @classmethod
     def order(cls, outcome):
         if isinstance(outcome, tuple):
-            category, subcategory = outcome
-
-            try:
-                return (cls.categories().index(category),
-                        cls.subcategories()[category].index(subcategory),
-                       )
-            except:
-                raise ValueError(category, subcategory)
+            return cls.order_pair(outcome)
         else:
-            category = outcome
-            try:
-                return cls.categories().index(category)
-            except:
-                raise ValueError(category)
+            return cls.order_single(outcome)
+
+    @memoized_per_class
+    def order_by_outcome(cls):
+        ''' order() of every category and (category, subcategory) in category_order,
+        so that sorts can look orders up instead of recomputing them. Callers should
+        fall back to order() for outcomes that aren't in the table.
+        '''
+        order_by_outcome = {}
+        for category, subcategories in cls.category_order:
+            order_by_outcome[category] = cls.order_single(category)
+            for subcategory in subcategories:
+                outcome = (category, subcategory)
+                order_by_outcome[outcome] = cls.order_pair(outcome)
+
+        return types.MappingProxyType(order_by_outcome)
+
+    @memoized_per_class
+    def sanitized_string_lookups(cls):
+        ''' Dictionaries between every outcome in category_order and its sanitized
+        string, built once per class.
+        '''
+        outcome_to_sanitized = {}
+        sanitized_to_outcome = {}
+        for c, (category, subcategories) in enumerate(cls.category_order):
+            sanitized = f'category{c:03d}'
+            outcome_to_sanitized.setdefault(category, sanitized)
+            sanitized_to_outcome[sanitized] = category
+
+            for s, subcategory in enumerate(subcategories):
+                outcome = (category, subcategory)
+                sanitized = f'category{c:03d}_subcategory{s:03d}'
+                outcome_to_sanitized.setdefault(outcome, sanitized)
+                sanitized_to_outcome[sanitized] = outcome
+
+        return types.MappingProxyType(outcome_to_sanitized), types.MappingProxyType(sanitized_to_outcome)
 
     @classmethod
     def outcome_to_sanitized_string(cls, outcome):
-        if isinstance(outcome, tuple):
-            c, s = cls.order(outcome)
-            return f'category{c:03d}_subcategory{s:03d}'
-        else:
-            c = cls.order(outcome)
-            return f'category{c:03d}'
+        outcome_to_sanitized, _ = cls.sanitized_string_lookups()
+        try:
+            return outcome_to_sanitized[outcome]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f'unknown outcome: {outcome!r}') from e
 
     @classmethod
     def sanitized_string_to_outcome(cls, sanitized_string):
-        match = re.match('category(\d+)_subcategory(\d+)', sanitized_string)
-        if match:
-            c, s = map(int, match.groups())
-            category, subcats = cls.category_order[c]
-            subcategory = subcats[s]
-            return category, subcategory
-        else:
-            match = re.match('category(\d+)', sanitized_string)
-            if not match:
-                raise ValueError(sanitized_string)
-            c = int(match.group(1))
-            category, subcats = cls.category_order[c]
-            return category
+        _, sanitized_to_outcome = cls.sanitized_string_lookups()
+        try:
+            return sanitized_to_outcome[sanitized_string]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f'unknown sanitized outcome string: {sanitized_string!r}') from e
 
     def q_to_feature_offset(self, al, feature_name, target_info=None):
         ''' Returns dictionary of
@@ -293,7 +421,7 @@ class Categorizer:
             if is_reverse:
                 # Need to extract query_qualities before overwriting query_sequence.
                 flipped_query_qualities = al.query_qualities[::-1]
-                al.query_sequence = utilities.reverse_complement(al.query_sequence)
+                al.query_sequence = self.seq_rc
                 al.query_qualities = flipped_query_qualities
                 al.is_reverse = True
                 al.cigar = al.cigar[::-1]
@@ -409,6 +537,16 @@ class Layout(Categorizer):
         ),
     ]
 
+    # Checks for a malformed layout, applied in order after the length check.
+    # The first one that applies determines the subcategory.
+    malformed_layout_checks = [
+        ('no alignments detected', lambda layout: all(al.is_unmapped for al in layout.alignments)),
+        ('extra copy of primer', lambda layout: layout.extra_copy_of_primer),
+        ('missing a primer', lambda layout: layout.missing_a_primer),
+        ('primers not in same orientation', lambda layout: layout.primer_strands[5] != layout.primer_strands[3]),
+        ('primer far from read edge', lambda layout: not layout.primer_alignments_reach_edges),
+    ]
+
     def __init__(self, alignments, target_info, error_corrected=False, mode='illumina'):
         self.mode = mode
 
@@ -424,11 +562,22 @@ class Layout(Categorizer):
         self.original_alignments = [al for al in alignments if not al.is_unmapped]
         self.unmapped_alignments = [al for al in alignments if al.is_unmapped]
 
+        # Bucket alignments by reference once so that each of the per-reference
+        # properties below doesn't have to rescan every alignment.
+        self.original_alignments_by_ref = defaultdict(list)
+        for al in self.original_alignments:
+            self.original_alignments_by_ref[al.reference_name].append(al)
+
         alignment = alignments[0]
         self.name = alignment.query_name
         self.query_name = self.name
         self.seq = sam.get_original_seq(alignment)
-        self.qual = np.array(sam.get_original_qual(alignment))
+        # Qualities fit in a byte, so avoid np.array's default int64 allocation.
+        qual = sam.get_original_qual(alignment)
+        if qual is None:
+            self.qual = None
+        else:
+            self.qual = np.asarray(qual, dtype=np.uint8)
 
         self.relevant_alignments = self.original_alignments
 
@@ -442,6 +591,33 @@ class Layout(Categorizer):
         self.inferred_amplicon_length = length
         self.categorized = False
 
+        self.query_covered_cache = {}
+
+    def query_covered(self, al):
+        ''' Memoized interval.get_covered(al).
+        Cached values hold a reference to al so that its id can't be reused by another alignment.
+        '''
+        key = id(al)
+        if key not in self.query_covered_cache:
+            self.query_covered_cache[key] = (al, interval.get_covered(al))
+
+        return self.query_covered_cache[key][1]
+
+    @property
+    def relevant_alignments(self):
+        # Flipping for '-' strand reads is deferred until relevant_alignments
+        # is actually read, since bulk categorization never looks at them.
+        if self.relevant_alignments_need_flipping:
+            self._relevant_alignments = [sam.flip_alignment(al) for al in self._relevant_alignments]
+            self.relevant_alignments_need_flipping = False
+
+        return self._relevant_alignments
+
+    @relevant_alignments.setter
+    def relevant_alignments(self, als):
+        self._relevant_alignments = als
+        self.relevant_alignments_need_flipping = False
+
     @memoized_property
     def target_alignments(self):
         if self.seq is None:
@@ -452,7 +628,7 @@ class Layout(Categorizer):
         primers = ti.primers_by_side_of_target
         target_seq_bytes = ti.reference_sequence_bytes[ti.target]
 
-        original_als = [al for al in self.original_alignments if al.reference_name == ti.target]
+        original_als = self.original_alignments_by_ref.get(ti.target, [])
 
         processed_als = []
 
@@ -474,11 +650,7 @@ class Layout(Categorizer):
             if extend_before or extend_after:
                 al = sw.extend_repeatedly(al, target_seq_bytes, extend_before=extend_before, extend_after=extend_after)
 
-            split_als = comprehensively_split_alignment(al, ti, self.mode)
-
-            extended = [sw.extend_alignment(split_al, target_seq_bytes) for split_al in split_als]
-
-            processed_als.extend(extended)
+            processed_als.extend(split_and_extend_alignment(al, ti, self.mode))
 
         # If processed alignments don't cover either edge, this typically means non-specific amplification.
         # Try to realign each uncovered edge to the relevant primer to check for this.
@@ -506,7 +678,7 @@ class Layout(Categorizer):
         if self.target_info.donor is None:
             return []
 
-        original_als = [al for al in self.original_alignments if al.reference_name == self.target_info.donor]
+        original_als = self.original_alignments_by_ref.get(self.target_info.donor, [])
         processed_als = []
 
         for al in original_als:
@@ -520,7 +692,7 @@ class Layout(Categorizer):
         if self.target_info.nonhomologous_donor is None:
             return []
 
-        original_als = [al for al in self.original_alignments if al.reference_name == self.target_info.nonhomologous_donor]
+        original_als = self.original_alignments_by_ref.get(self.target_info.nonhomologous_donor, [])
         processed_als = []
 
         for al in original_als:
@@ -532,15 +704,18 @@ class Layout(Categorizer):
     @memoized_property
     def nonredundant_supplemental_alignments(self):
         primary_als = self.parsimonious_and_gap_alignments + self.nonhomologous_donor_alignments + self.extra_alignments
-        covered = interval.get_disjoint_covered(primary_als)
+        covered = covered_mask(primary_als, len(self.seq))
 
-        supp_als_to_keep = []
+        counts = np.concatenate([[0], np.cumsum(covered)])
 
-        for al in self.supplemental_alignments:
-            if interval.get_covered(al) - covered:
-                supp_als_to_keep.append(al)
+        starts, ends, lengths = self.supplemental_arrays
+        fully_covered = counts[ends + 1] - counts[starts] == ends - starts + 1
 
-        supp_als_to_keep = sorted(supp_als_to_keep, key=lambda al: al.query_alignment_length, reverse=True)
+        to_keep = np.flatnonzero(~fully_covered)
+        # Stable sort so that ties keep their original order.
+        order = to_keep[np.argsort(-lengths[to_keep], kind='stable')]
+
+        supp_als_to_keep = [self.supplemental_alignments[i] for i in order]
         return supp_als_to_keep
 
     @memoized_property
@@ -556,13 +731,21 @@ class Layout(Categorizer):
         def priority(al):
             return al.query_alignment_length - al.get_tag('NM')
 
-        best_als = sorted(als, key=priority, reverse=True)[:100]
+        best_als = heapq.nlargest(100, als, key=priority)
 
-        split_als = []
-        for al in best_als:
-            split_als.extend(sam.split_at_large_insertions(al, 10))
+        return list(itertools.chain.from_iterable(sam.split_at_large_insertions(al, 10) for al in best_als))
 
-        return split_als
+    @memoized_property
+    def supplemental_arrays(self):
+        ''' Query starts, query ends, and query_alignment_lengths of supplemental_alignments
+        as parallel arrays, so that filters over them can be vectorized.
+        '''
+        als = self.supplemental_alignments
+        covered = [self.query_covered(al) for al in als]
+        starts = np.array([c.start for c in covered], dtype=int)
+        ends = np.array([c.end for c in covered], dtype=int)
+        lengths = np.array([al.query_alignment_length for al in als], dtype=int)
+        return SupplementalArrays(starts, ends, lengths)
 
     @memoized_property
     def extra_alignments(self):
@@ -607,7 +790,7 @@ class Layout(Categorizer):
                 # This is an error condition.
                 target_edge_before = -1
 
-            right_target_al_cropped = sam.crop_al_to_query_int(right_target_al, right_junction['switch_after'] + 1, np.inf)
+            right_target_al_cropped = sam.crop_al_to_query_int(right_target_al, right_junction['switch_after'] + 1, sys.maxsize)
             if right_target_al_cropped is not None:
                 target_edge_after = right_target_al_cropped.reference_start
             else:
@@ -627,7 +810,7 @@ class Layout(Categorizer):
             else:
                 target_edge_after = -1
 
-            right_target_al_cropped = sam.crop_al_to_query_int(right_target_al, right_junction['switch_after'] + 1, np.inf)
+            right_target_al_cropped = sam.crop_al_to_query_int(right_target_al, right_junction['switch_after'] + 1, sys.maxsize)
             if right_target_al_cropped is not None:
                 target_edge_before = right_target_al_cropped.reference_end - 1
             else:
@@ -667,48 +850,42 @@ class Layout(Categorizer):
             c, s, d = self.categorize_with_donor()
 
         if self.strand == '-':
-            self.relevant_alignments = [sam.flip_alignment(al) for al in self.relevant_alignments]
+            self.relevant_alignments_need_flipping = True
 
         return c, s, d
 
-    def categorize_with_donor(self):
-        self.details = 'n/a'
-        self.outcome = knock_knock.outcome.Outcome('')
+    def malformed_layout_subcategory(self, too_short_margin):
+        ''' Returns the 'malformed layout' subcategory that applies to this read, or None.
+        Reads no more than too_short_margin longer than the combined primers are too short.
+        '''
+        if self.seq is None or len(self.seq) <= self.target_info.combined_primer_length + too_short_margin:
+            return 'too short'
 
-        if self.seq is None or len(self.seq) <= self.target_info.combined_primer_length + 10:
-            self.category = 'malformed layout'
-            self.subcategory = 'too short'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+        for subcategory, check in self.malformed_layout_checks:
+            if check(self):
+                return subcategory
 
-        elif all(al.is_unmapped for al in self.alignments):
-            self.category = 'malformed layout'
-            self.subcategory = 'no alignments detected'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+        return None
 
-        elif self.extra_copy_of_primer:
-            self.category = 'malformed layout'
-            self.subcategory = 'extra copy of primer'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+    def categorize_with_donor(self):
+        self.details = 'n/a'
+        self.outcome = knock_knock.outcome.Outcome('')
 
-        elif self.missing_a_primer:
-            self.category = 'malformed layout'
-            self.subcategory = 'missing a primer'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+        # Branches that pick relevant alignments directly record them here and they are
+        # assigned once at the end; register_* methods assign their own.
+        relevant_alignments = None
 
-        elif self.primer_strands[5] != self.primer_strands[3]:
-            self.category = 'malformed layout'
-            self.subcategory = 'primers not in same orientation'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+        malformed = self.malformed_layout_subcategory(10)
 
-        elif not self.primer_alignments_reach_edges:
+        if malformed is not None:
             self.category = 'malformed layout'
-            self.subcategory = 'primer far from read edge'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+            self.subcategory = malformed
+            relevant_alignments = self.uncategorized_relevant_alignments
 
         elif not self.has_integration:
             if self.indel_near_cut is not None:
                 self.details = self.indel_string
-                self.relevant_alignments = self.parsimonious_target_alignments
+                relevant_alignments = self.parsimonious_target_alignments
 
                 if len(self.indel_near_cut) > 1:
                     self.category = 'uncategorized'
@@ -734,12 +911,12 @@ class Layout(Categorizer):
                 self.category = 'uncategorized'
                 self.subcategory = 'mismatch(es) near cut'
                 self.details = 'n/a'
-                self.relevant_alignments = self.uncategorized_relevant_alignments
+                relevant_alignments = self.uncategorized_relevant_alignments
 
             else:
                 self.category = 'WT'
                 self.subcategory = 'WT'
-                self.relevant_alignments = self.parsimonious_target_alignments
+                relevant_alignments = self.parsimonious_target_alignments
 
         elif self.integration_summary == 'donor':
             junctions = set(self.junction_summary_per_side.values())
@@ -747,13 +924,13 @@ class Layout(Categorizer):
             if junctions == set(['HDR']):
                 self.category = 'HDR'
                 self.subcategory = 'HDR'
-                self.relevant_alignments = self.parsimonious_and_gap_alignments
+                relevant_alignments = self.parsimonious_and_gap_alignments
 
             elif self.gap_covered_by_target_alignment:
                 self.category = 'complex indel'
                 self.subcategory = 'complex indel'
                 self.details = 'n/a'
-                self.relevant_alignments = self.parsimonious_and_gap_alignments
+                relevant_alignments = self.parsimonious_and_gap_alignments
 
             elif junctions == set(['imperfect']):
                 if self.not_covered_by_simple_integration.total_length >= 2:
@@ -764,7 +941,7 @@ class Layout(Categorizer):
                     self.subcategory = f'5\' {self.junction_summary_per_side[5]}, 3\' {self.junction_summary_per_side[3]}'
                     self.details = self.register_integration_details()
 
-                self.relevant_alignments = self.parsimonious_and_gap_alignments
+                relevant_alignments = self.parsimonious_and_gap_alignments
 
             else:
                 self.subcategory = f'5\' {self.junction_summary_per_side[5]}, 3\' {self.junction_summary_per_side[3]}'
@@ -786,14 +963,14 @@ class Layout(Categorizer):
                     self.subcategory = 'complex misintegration'
                     self.details = 'n/a'
 
-                self.relevant_alignments = self.parsimonious_and_gap_alignments
+                relevant_alignments = self.parsimonious_and_gap_alignments
 
         # TODO: check here for HA extensions into donor specific
         elif self.gap_covered_by_target_alignment:
             self.category = 'complex indel'
             self.subcategory = 'complex indel'
             self.details = 'n/a'
-            self.relevant_alignments = self.parsimonious_and_gap_alignments
+            relevant_alignments = self.parsimonious_and_gap_alignments
 
         elif self.integration_interval.total_length <= 5:
             if self.target_to_at_least_cut[5] and self.target_to_at_least_cut[3]:
@@ -803,7 +980,7 @@ class Layout(Categorizer):
                 self.category = 'complex indel'
                 self.subcategory = 'complex indel'
             self.details = 'n/a'
-            self.relevant_alignments = self.parsimonious_and_gap_alignments
+            relevant_alignments = self.parsimonious_and_gap_alignments
 
         elif self.integration_summary == 'concatamer':
             if self.target_info.donor_type == 'plasmid':
@@ -815,7 +992,7 @@ class Layout(Categorizer):
                 self.subcategory = self.junction_summary
                 self.details = self.register_integration_details()
 
-            self.relevant_alignments = self.parsimonious_and_gap_alignments
+            relevant_alignments = self.parsimonious_and_gap_alignments
 
         elif self.nonhomologous_donor_integration is not None:
             self.category = 'non-homologous donor'
@@ -826,7 +1003,7 @@ class Layout(Categorizer):
             MH_nts = self.NH_donor_microhomology
             self.details = f'{NH_strand},{MH_nts[5]},{MH_nts[3]}'
 
-            self.relevant_alignments = self.parsimonious_target_alignments + self.nonhomologous_donor_alignments
+            relevant_alignments = self.parsimonious_target_alignments + self.nonhomologous_donor_alignments
 
         elif self.nonspecific_amplification is not None:
             self.register_nonspecific_amplification()
@@ -839,57 +1016,41 @@ class Layout(Categorizer):
             self.subcategory = 'complex'
             self.details = 'n/a'
 
-            self.relevant_alignments = self.parsimonious_target_alignments + self.nonhomologous_donor_alignments + self.nonredundant_supplemental_alignments
+            relevant_alignments = self.parsimonious_target_alignments + self.nonhomologous_donor_alignments + self.nonredundant_supplemental_alignments
 
         elif self.any_donor_specific_present:
             self.category = 'complex misintegration'
             self.subcategory = 'complex misintegration'
             self.details = 'n/a'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+            relevant_alignments = self.uncategorized_relevant_alignments
 
         elif self.integration_summary in ['donor with indel', 'other', 'unexpected length', 'unexpected source']:
             self.category = 'uncategorized'
             self.subcategory = self.integration_summary
 
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+            relevant_alignments = self.uncategorized_relevant_alignments
 
         else:
             print(self.integration_summary)
 
+        if relevant_alignments is not None:
+            self.relevant_alignments = relevant_alignments
+
         return self.category, self.subcategory, self.details
 
     def categorize_no_donor(self):
         self.details = 'n/a'
 
-        if self.seq is None or len(self.seq) <= self.target_info.combined_primer_length + 15:
-            self.category = 'malformed layout'
-            self.subcategory = 'too short'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
-
-        elif all(al.is_unmapped for al in self.alignments):
-            self.category = 'malformed layout'
-            self.subcategory = 'no alignments detected'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+        # Branches that pick relevant alignments directly record them here and they are
+        # assigned once at the end; register_* methods assign their own.
+        relevant_alignments = None
 
-        elif self.extra_copy_of_primer:
-            self.category = 'malformed layout'
-            self.subcategory = 'extra copy of primer'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
-
-        elif self.missing_a_primer:
-            self.category = 'malformed layout'
-            self.subcategory = 'missing a primer'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+        malformed = self.malformed_layout_subcategory(15)
 
-        elif self.primer_strands[5] != self.primer_strands[3]:
+        if malformed is not None:
             self.category = 'malformed layout'
-            self.subcategory = 'primers not in same orientation'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
-
-        elif not self.primer_alignments_reach_edges:
-            self.category = 'malformed layout'
-            self.subcategory = 'primer far from read edge'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+            self.subcategory = malformed
+            relevant_alignments = self.uncategorized_relevant_alignments
 
         elif self.single_merged_primer_alignment is not None:
             num_indels = len(self.all_indels_near_cuts)
@@ -916,15 +1077,15 @@ class Layout(Categorizer):
                         split_at_dels = sam.split_at_deletions(al, 1)
                         for split_al in split_at_dels:
                             split_at_both.extend(sam.split_at_large_insertions(split_al, 1))
-                    self.relevant_alignments = split_at_both
+                    relevant_alignments = split_at_both
                 else:
-                    self.relevant_alignments = self.parsimonious_target_alignments
+                    relevant_alignments = self.parsimonious_target_alignments
 
                 self.details = ' '.join(map(str, self.all_indels_near_cuts))
             else:
                 self.category = 'WT'
                 self.subcategory = 'WT'
-                self.relevant_alignments = self.parsimonious_target_alignments
+                relevant_alignments = self.parsimonious_target_alignments
 
         elif self.nonspecific_amplification is not None:
             self.register_nonspecific_amplification()
@@ -937,6 +1098,9 @@ class Layout(Categorizer):
             self.subcategory = 'uncategorized'
             self.details = 'n/a'
 
+        if relevant_alignments is not None:
+            self.relevant_alignments = relevant_alignments
+
         return self.category, self.subcategory, self.details
 
     @memoized_property
@@ -983,7 +1147,7 @@ class Layout(Categorizer):
             soft_clip_length = len(self.seq) - len(read)
 
             targets = [('amplicon_side', amplicon_side_seq)]
-            temp_header = pysam.AlignmentHeader.from_references([n for n, s in targets], [len(s) for n, s in targets])
+            temp_header = single_reference_header('amplicon_side', len(amplicon_side_seq))
 
             als = sw.align_read(read, targets, 5, temp_header,
                                 alignment_type=alignment_type,
@@ -1010,7 +1174,7 @@ class Layout(Categorizer):
                     primer_query_interval = interval.Interval(0, len(primer) - 1)
                 elif read_side == 3:
                     # can't just use buffer_length as start in case read is shorter than primer + buffer_length
-                    primer_query_interval = interval.Interval(len(read) - len(primer), np.inf)
+                    primer_query_interval = interval.Interval(len(read) - len(primer), sys.maxsize)
 
                 if amplicon_side != read_side:
                     al = sam.flip_alignment(al)
@@ -1021,7 +1185,7 @@ class Layout(Categorizer):
                     al.reference_start = al.reference_start + ref_start_offset
                     al.cigar = sam.collapse_soft_clip_blocks(new_cigar)
                     if al.is_reverse:
-                        seq = utilities.reverse_complement(self.seq)
+                        seq = self.seq_rc
                         qual = self.qual[::-1]
                     else:
                         seq = self.seq
@@ -1044,11 +1208,21 @@ class Layout(Categorizer):
     @memoized_property
     def all_primer_alignments(self):
         ''' Get all alignments that contain the amplicon primers. '''
+        parsimonious_als = self.parsimonious_alignments
+
+        # Collect reference names and bounds once so that each primer only
+        # needs an array comparison to find candidate alignments.
+        ref_names = np.array([al.reference_name for al in parsimonious_als], dtype=object)
+        ref_starts = np.fromiter((al.reference_start for al in parsimonious_als), dtype=int, count=len(parsimonious_als))
+        ref_ends = np.fromiter((al.reference_end - 1 for al in parsimonious_als), dtype=int, count=len(parsimonious_als))
+
         als = {}
         for side, primer in self.target_info.primers_by_side_of_target.items():
+            candidates = np.flatnonzero((ref_names == primer.seqname) & (ref_starts <= primer.end) & (ref_ends >= primer.start))
+
             # Prefer to have the primers annotated on the strand they anneal to,
             # so don't require strand match here.
-            als[side] = [al for al in self.parsimonious_alignments if sam.overlaps_feature(al, primer, False)]
+            als[side] = [parsimonious_als[i] for i in candidates if sam.overlaps_feature(parsimonious_als[i], primer, False)]
 
         return als
 
@@ -1147,7 +1321,7 @@ class Layout(Categorizer):
         gap_als = []
         if self.gap_between_primer_alignments.total_length >= 10:
             for al in self.target_alignments:
-                if (self.integration_interval - interval.get_covered(al)).total_length <= 2:
+                if (self.integration_interval - self.query_covered(al)).total_length <= 2:
                     gap_als.append(al)
 
         return gap_als
@@ -1174,22 +1348,14 @@ class Layout(Categorizer):
     @memoized_property
     def primer_alignments(self):
         ''' Get the single alignment containing each primer. '''
-        primer_als = {5: None, 3: None}
-        for side in [5, 3]:
-            if len(self.all_primer_alignments[side]) == 1:
-                primer_als[side] = self.all_primer_alignments[side][0]
+        all_primer_als = self.all_primer_alignments
 
-        return primer_als
+        return Sides(*(all_primer_als[side][0] if len(all_primer_als[side]) == 1 else None for side in [5, 3]))
 
     @memoized_property
     def primer_strands(self):
         ''' Get which strand each primer-containing alignment mapped to. '''
-        strands = {5: None, 3: None}
-        for side in [5, 3]:
-            al = self.primer_alignments[side]
-            if al is not None:
-                strands[side] = sam.get_strand(al)
-        return strands
+        return Sides(*(sam.get_strand(al) if al is not None else None for al in self.primer_alignments.values()))
 
     @memoized_property
     def strand(self):
@@ -1301,14 +1467,17 @@ class Layout(Categorizer):
         if merged_primer_al is None:
             return []
         else:
-            mismatches = []
-            tuples = sam.aligned_tuples(merged_primer_al, self.target_info.target_sequence)
-            for true_read_i, read_b, ref_i, ref_b, qual in tuples:
-                if ref_i is not None and true_read_i is not None:
-                    if read_b != ref_b and ref_i in self.near_cut_intervals:
-                        mismatches.append(ref_i)
+            ti = self.target_info
+
+            pairs = np.array(merged_primer_al.get_aligned_pairs(matches_only=True), dtype=int).reshape(-1, 2)
+            read_ps, ref_ps = pairs.T
 
-            return mismatches
+            read_bs = np.frombuffer(merged_primer_al.query_sequence.encode(), dtype=np.uint8)[read_ps]
+            ref_bs = np.frombuffer(ti.reference_sequence_bytes[ti.target], dtype=np.uint8)[ref_ps]
+
+            is_mismatch_near_cut = (read_bs != ref_bs) & self.near_cut_mask[ref_ps]
+
+            return ref_ps[is_mismatch_near_cut].tolist()
 
     @memoized_property
     def indel_near_cut(self):
@@ -1342,12 +1511,11 @@ class Layout(Categorizer):
         for indel in self.indels:
             if indel.kind == 'D':
                 d = indel
-                d_interval = interval.Interval(min(d.starts_ats), max(d.starts_ats) + d.length - 1)
-                if d_interval & self.near_cut_intervals:
+                if self.overlaps_near_cut(min(d.starts_ats), max(d.starts_ats) + d.length - 1):
                     indels_near_cuts.append(d)
             elif indel.kind == 'I':
                 ins = indel
-                if any(sa in self.near_cut_intervals for sa in ins.starts_afters):
+                if any(self.overlaps_near_cut(sa, sa) for sa in ins.starts_afters):
                     indels_near_cuts.append(ins)
 
         return indels_near_cuts
@@ -1356,18 +1524,42 @@ class Layout(Categorizer):
     def near_cut_intervals(self):
         return self.target_info.around_cuts(10)
 
+    @memoized_property
+    def near_cut_mask(self):
+        ''' near_cut_intervals as a boolean array over target positions. '''
+        return self.target_info.around_cuts_mask(10)
+
+    def overlaps_near_cut(self, start, end):
+        ''' Whether the inclusive target interval [start, end] overlaps near_cut_intervals. '''
+        return bool(self.near_cut_mask[max(start, 0):end + 1].any())
+
+    @memoized_property
+    def near_cut_cumulative_counts(self):
+        ''' Entry i is the number of near-cut target positions before i. '''
+        return np.concatenate([[0], np.cumsum(self.near_cut_mask)])
+
+    def overlaps_near_cut_array(self, starts, ends):
+        ''' Vectorized overlaps_near_cut over arrays of inclusive interval bounds. '''
+        counts = self.near_cut_cumulative_counts
+        starts = np.clip(starts, 0, len(counts) - 1)
+        ends = np.clip(ends + 1, 0, len(counts) - 1)
+        return counts[ends] - counts[starts] > 0
+
     @memoized_property
     def largest_deletion_near_cut(self):
         dels = [indel for indel in self.indels if indel.kind == 'D']
 
-        near_cut = []
-        for deletion in dels:
-            del_interval = interval.Interval(min(deletion.starts_ats), max(deletion.starts_ats) + deletion.length - 1)
-            if del_interval & self.near_cut_intervals:
-                near_cut.append(deletion)
+        if len(dels) == 0:
+            return None
 
-        if near_cut:
-            largest = max(near_cut, key=lambda d: d.length)
+        starts = np.array([min(d.starts_ats) for d in dels], dtype=int)
+        ends = np.array([max(d.starts_ats) + d.length - 1 for d in dels], dtype=int)
+        lengths = np.array([d.length for d in dels])
+
+        near_cut = self.overlaps_near_cut_array(starts, ends)
+
+        if near_cut.any():
+            largest = dels[np.argmax(np.where(near_cut, lengths, -1))]
             largest = self.target_info.expand_degenerate_indel(largest)
         else:
             largest = None
@@ -1378,10 +1570,20 @@ class Layout(Categorizer):
     def largest_insertion_near_cut(self):
         insertions = [indel for indel in self.indels if indel.kind == 'I']
 
-        near_cut = [ins for ins in insertions if any(sa in self.near_cut_intervals for sa in ins.starts_afters)]
+        if len(insertions) == 0:
+            return None
+
+        # Flatten every possible starts_after, remembering which insertion it came from.
+        starts_afters = np.array([sa for ins in insertions for sa in ins.starts_afters], dtype=int)
+        owners = np.repeat(np.arange(len(insertions)), [len(ins.starts_afters) for ins in insertions])
 
-        if near_cut:
-            largest = max(near_cut, key=lambda ins: len(ins.seqs[0]))
+        near_cut = np.zeros(len(insertions), dtype=bool)
+        np.logical_or.at(near_cut, owners, self.overlaps_near_cut_array(starts_afters, starts_afters))
+
+        lengths = np.array([len(ins.seqs[0]) for ins in insertions])
+
+        if near_cut.any():
+            largest = insertions[np.argmax(np.where(near_cut, lengths, -1))]
             largest = self.target_info.expand_degenerate_indel(largest)
         else:
             largest = None
@@ -1406,13 +1608,21 @@ class Layout(Categorizer):
         ''' identification of gap_alignments requires further processing of parsimonious alignments '''
         return sam.make_nonredundant(interval.make_parsimonious(self.parsimonious_alignments + self.sw_gap_alignments))
 
+    @memoized_property
+    def parsimonious_and_gap_alignments_by_ref(self):
+        als_by_ref = defaultdict(list)
+        for al in self.parsimonious_and_gap_alignments:
+            als_by_ref[al.reference_name].append(al)
+
+        return als_by_ref
+
     @memoized_property
     def parsimonious_target_alignments(self):
-        return [al for al in self.parsimonious_and_gap_alignments if al.reference_name == self.target_info.target]
+        return self.parsimonious_and_gap_alignments_by_ref.get(self.target_info.target, [])
 
     @memoized_property
     def parsimonious_donor_alignments(self):
-        return [al for al in self.parsimonious_and_gap_alignments if al.reference_name == self.target_info.donor]
+        return self.parsimonious_and_gap_alignments_by_ref.get(self.target_info.donor, [])
 
     @memoized_property
     def closest_donor_alignment_to_edge(self):
@@ -1421,19 +1631,15 @@ class Layout(Categorizer):
         donor_als = self.parsimonious_donor_alignments
 
         if self.strand is None or len(donor_als) == 0:
-            closest = {5: None, 3: None}
+            closest = Sides(None, None)
         else:
-            closest = {}
-
-            left_most = min(donor_als, key=lambda al: interval.get_covered(al).start)
-            right_most = max(donor_als, key=lambda al: interval.get_covered(al).end)
+            left_most = min(donor_als, key=lambda al: self.query_covered(al).start)
+            right_most = max(donor_als, key=lambda al: self.query_covered(al).end)
 
             if self.strand == '+':
-                closest[5] = left_most
-                closest[3] = right_most
+                closest = Sides(left_most, right_most)
             else:
-                closest[5] = right_most
-                closest[3] = left_most
+                closest = Sides(right_most, left_most)
 
         return closest
 
@@ -1476,7 +1682,7 @@ class Layout(Categorizer):
         }
 
         donor_past_HA = {
-            5: sam.crop_al_to_ref_int(closest_donor[5], HAs[5]['donor'].end + 1, np.inf),
+            5: sam.crop_al_to_ref_int(closest_donor[5], HAs[5]['donor'].end + 1, sys.maxsize),
             3: sam.crop_al_to_ref_int(closest_donor[3], 0, HAs[3]['donor'].start - 1),
         }
 
@@ -1545,45 +1751,47 @@ class Layout(Categorizer):
     def edge_q(self):
         ''' Where in the query are the edges of the integration? '''
         if self.strand == '+':
-            edge_q = {
-                5: self.integration_interval.start,
-                3: self.integration_interval.end,
-            }
+            edge_q = Sides(self.integration_interval.start, self.integration_interval.end)
         else:
-            edge_q = {
-                5: self.integration_interval.end,
-                3: self.integration_interval.start,
-            }
+            edge_q = Sides(self.integration_interval.end, self.integration_interval.start)
         return edge_q
 
     @memoized_property
     def edge_r(self):
         ''' Where in the donor are the edges of the integration? '''
-        all_edge_rs = {
-            5: [],
-            3: [],
-        }
+        integration_interval = self.integration_interval
+        donor_als = self.parsimonious_donor_alignments
 
-        for al in self.parsimonious_donor_alignments:
-            cropped = sam.crop_al_to_query_int(al, self.integration_interval.start, self.integration_interval.end)
-            if cropped is None:
-                continue
-            start = cropped.reference_start
-            end = cropped.reference_end - 1
-            all_edge_rs[5].append(start)
-            all_edge_rs[3].append(end)
+        if integration_interval is None or len(donor_als) == 0:
+            return Sides(None, None)
 
-        edge_r = {}
+        covered = [self.query_covered(al) for al in donor_als]
+        query_starts = np.array([c.start for c in covered], dtype=int)
+        query_ends = np.array([c.end for c in covered], dtype=int)
 
-        if all_edge_rs[5]:
-            edge_r[5] = min(all_edge_rs[5])
-        else:
-            edge_r[5] = None
+        # Alignments entirely inside the integration interval don't need to be cropped,
+        # and alignments entirely outside of it would crop to nothing.
+        contained = (query_starts >= integration_interval.start) & (query_ends <= integration_interval.end)
+        overlapping = (query_ends >= integration_interval.start) & (query_starts <= integration_interval.end)
+
+        ref_starts = []
+        ref_ends = []
+
+        for i in np.flatnonzero(overlapping):
+            if contained[i]:
+                al = donor_als[i]
+            else:
+                al = sam.crop_al_to_query_int(donor_als[i], integration_interval.start, integration_interval.end)
+                if al is None:
+                    continue
 
-        if all_edge_rs[3]:
-            edge_r[3] = max(all_edge_rs[3])
+            ref_starts.append(al.reference_start)
+            ref_ends.append(al.reference_end - 1)
+
+        if ref_starts:
+            edge_r = Sides(int(np.min(ref_starts)), int(np.max(ref_ends)))
         else:
-            edge_r[3] = None
+            edge_r = Sides(None, None)
 
         return edge_r
 
@@ -1591,20 +1799,23 @@ class Layout(Categorizer):
     def donor_relative_to_arm(self):
         ''' How much of the donor is integrated relative to the edges of the HAs? '''
         HAs = self.target_info.homology_arms
+        HA_5_donor = HAs[5]['donor']
+        HA_3_donor = HAs[3]['donor']
+        edge_r_5, edge_r_3 = self.edge_r[5], self.edge_r[3]
 
         # convention: positive if there is extra in the integration, negative if truncated
         relative_to_arm = {
             'internal': {
-                5: ((HAs[5]['donor'].end + 1) - self.edge_r[5]
-                    if self.edge_r[5] is not None else None),
-                3: (self.edge_r[3] - (HAs[3]['donor'].start - 1)
-                    if self.edge_r[3] is not None else None),
+                5: ((HA_5_donor.end + 1) - edge_r_5
+                    if edge_r_5 is not None else None),
+                3: (edge_r_3 - (HA_3_donor.start - 1)
+                    if edge_r_3 is not None else None),
             },
             'external': {
-                5: (HAs[5]['donor'].start - self.edge_r[5]
-                    if self.edge_r[5] is not None else None),
-                3: (self.edge_r[3] - HAs[3]['donor'].end
-                    if self.edge_r[3] is not None else None),
+                5: (HA_5_donor.start - edge_r_5
+                    if edge_r_5 is not None else None),
+                3: (edge_r_3 - HA_3_donor.end
+                    if edge_r_3 is not None else None),
             },
         }
 
@@ -1639,18 +1850,22 @@ class Layout(Categorizer):
 
     @memoized_property
     def donor_integration_is_blunt(self):
-        donor_length = len(self.target_info.donor_sequence)
+        ti = self.target_info
+        donor_length = len(ti.donor_sequence)
+        edge_r = self.edge_r
 
         reaches_end = {
-            5: self.edge_r[5] is not None and self.edge_r[5] <= 1,
-            3: self.edge_r[3] is not None and self.edge_r[3] >= donor_length - 2,
+            5: edge_r[5] is not None and edge_r[5] <= 1,
+            3: edge_r[3] is not None and edge_r[3] >= donor_length - 2,
         }
 
+        primer_als = self.primer_alignments
+        closest_donor_als = self.closest_donor_alignment_to_edge
+        reference_sequences = ti.reference_sequences
+
         short_gap = {}
         for side in [5, 3]:
-            primer_al = self.primer_alignments[side]
-            donor_al = self.closest_donor_alignment_to_edge[side]
-            overlap = junction_microhomology(self.target_info.reference_sequences, primer_al, donor_al)
+            overlap = junction_microhomology(reference_sequences, primer_als[side], closest_donor_als[side])
             short_gap[side] = overlap > -10
 
         is_blunt = {side: reaches_end[side] and short_gap[side] for side in [5, 3]}
@@ -1681,24 +1896,26 @@ class Layout(Categorizer):
         if not self.has_integration:
             return None
 
-        HAs = self.target_info.homology_arms
-        cut_after = self.target_info.cut_after
+        ti = self.target_info
+        HAs = ti.homology_arms
+        cut_after = ti.cut_after
+        clean_handoff = self.clean_handoff
 
         flanking_al = {}
-        mask_start = {5: -np.inf}
-        mask_end = {3: np.inf}
+        mask_start = {5: -sys.maxsize}
+        mask_end = {3: sys.maxsize}
         for side in [5, 3]:
-            if self.clean_handoff[side]:
+            if clean_handoff[side]:
                 flanking_al[side] = self.closest_donor_alignment_to_edge[side]
             else:
                 flanking_al[side] = self.primer_alignments[side]
 
-        if self.clean_handoff[5] or cut_after is None:
+        if clean_handoff[5] or cut_after is None:
             mask_end[5] = HAs[5]['donor'].end
         else:
             mask_end[5] = cut_after
 
-        if self.clean_handoff[3] or cut_after is None:
+        if clean_handoff[3] or cut_after is None:
             mask_start[3] = HAs[3]['donor'].start
         else:
             mask_start[3] = cut_after + 1
@@ -1712,23 +1929,23 @@ class Layout(Categorizer):
 
         if self.strand == '+':
             if covered[5] is not None:
-                start = interval.get_covered(covered[5]).end + 1
+                start = self.query_covered(covered[5]).end + 1
             else:
                 start = 0
 
             if covered[3] is not None:
-                end = interval.get_covered(covered[3]).start - 1
+                end = self.query_covered(covered[3]).start - 1
             else:
                 end = len(self.seq) - 1
 
         elif self.strand == '-':
             if covered[5] is not None:
-                end = interval.get_covered(covered[5]).start - 1
+                end = self.query_covered(covered[5]).start - 1
             else:
                 end = len(self.seq) - 1
 
             if covered[3] is not None:
-                start = interval.get_covered(covered[3]).end + 1
+                start = self.query_covered(covered[3]).end + 1
             else:
                 start = 0
 
@@ -1739,8 +1956,8 @@ class Layout(Categorizer):
         if self.primer_alignments[5] is None or self.primer_alignments[3] is None or self.strand is None:
             return interval.Interval.empty()
 
-        left_covered = interval.get_covered(self.primer_alignments[5])
-        right_covered = interval.get_covered(self.primer_alignments[3])
+        left_covered = self.query_covered(self.primer_alignments[5])
+        right_covered = self.query_covered(self.primer_alignments[3])
         if self.strand == '+':
             between_primers = interval.Interval(left_covered.start, right_covered.end)
         elif self.strand == '-':
@@ -1782,28 +1999,7 @@ class Layout(Categorizer):
     def junction_summary(self):
         per_side = self.junction_summary_per_side
 
-        if (per_side[5] == 'HDR' and
-            per_side[3] == 'HDR'):
-
-            summary = 'HDR'
-
-        elif (per_side[5] == 'blunt' and
-              per_side[3] == 'HDR'):
-
-            summary = "5' blunt"
-
-        elif (per_side[5] == 'HDR' and
-              per_side[3] == 'blunt'):
-
-            summary = "3' blunt"
-
-        elif (per_side[5] == 'blunt' and
-              per_side[3] == 'blunt'):
-
-            summary = "5' and 3' blunt"
-
-        else:
-            summary = 'incomplete'
+        summary = JUNCTION_SUMMARIES.get((per_side[5], per_side[3]), 'incomplete')
 
         # blunt isn't a meaningful concept for plasmid donors
         if self.target_info.donor_type == 'plasmid':
@@ -1816,18 +2012,26 @@ class Layout(Categorizer):
     def donor_specific_integration_alignments(self):
         integration_donor_als = []
 
+        # integration_interval is a single interval, so coverage of it by each
+        # al's query interval can be worked out from endpoints.
+        integration = self.integration_interval
+        if integration is None:
+            return integration_donor_als
+
+        has_integration = integration.total_length > 0
+
         for al in self.parsimonious_donor_alignments:
             if self.overlaps_donor_specific(al):
-                covered = interval.get_covered(al)
-                if (self.integration_interval.total_length > 0) and ((self.integration_interval - covered).total_length == 0):
+                covered = self.query_covered(al)
+                overlap_length = max(0, min(integration.end, covered.end) - max(integration.start, covered.start) + 1)
+
+                if has_integration and covered.start <= integration.start and covered.end >= integration.end:
                     # If a single donor al covers the whole integration, use just it.
                     integration_donor_als = [al]
                     break
-                else:
-                    covered_integration = self.integration_interval & interval.get_covered(al)
-                    # Ignore als that barely extend past the homology arms.
-                    if len(covered_integration) >= 5:
-                        integration_donor_als.append(al)
+                # Ignore als that barely extend past the homology arms.
+                elif overlap_length >= 5:
+                    integration_donor_als.append(al)
 
         return sorted(integration_donor_als, key=lambda al: al.query_alignment_length, reverse=True)
 
@@ -1838,7 +2042,7 @@ class Layout(Categorizer):
 
         elif len(self.donor_specific_integration_alignments) == 1:
             donor_al = self.donor_specific_integration_alignments[0]
-            covered_by_donor = interval.get_covered(donor_al)
+            covered_by_donor = self.query_covered(donor_al)
             uncovered_length = (self.integration_interval - covered_by_donor).total_length
 
             if uncovered_length > 10:
@@ -1876,33 +2080,32 @@ class Layout(Categorizer):
             return 0
 
         if self.strand == '+':
-            key = lambda al: interval.get_covered(al).start
+            key = lambda al: self.query_covered(al).start
             reverse = False
         else:
-            key = lambda al: interval.get_covered(al).end
+            key = lambda al: self.query_covered(al).end
             reverse = True
 
         five_to_three = sorted(p_donor_als, key=key, reverse=reverse)
-        junctions_clean = []
+
+        donor_length = len(ti.donor_sequence)
 
         for before, after in zip(five_to_three[:-1], five_to_three[1:]):
-            before_int = interval.get_covered(before)
-            after_int = interval.get_covered(after)
+            before_int = self.query_covered(before)
+            after_int = self.query_covered(after)
 
-            adjacent = interval.are_adjacent(before_int, after_int)
-            overlap_slightly = len(before_int & after_int) <= 2
+            # Adjacent intervals have no overlap, so a junction is acceptable
+            # exactly when the query intervals overlap by at most 2 nts.
+            overlap_length = min(before_int.end, after_int.end) - max(before_int.start, after_int.start) + 1
+            overlap_slightly = overlap_length <= 2
 
-            missing_before = len(ti.donor_sequence) - before.reference_end
+            missing_before = donor_length - before.reference_end
             missing_after = after.reference_start
 
-            clean = (adjacent or overlap_slightly) and (missing_before <= 1) and (missing_after <= 1)
+            if not (overlap_slightly and missing_before <= 1 and missing_after <= 1):
+                return 0
 
-            junctions_clean.append(clean)
-
-        if all(junctions_clean):
-            return len(junctions_clean) + 1
-        else:
-            return 0
+        return len(five_to_three)
 
     @memoized_property
     def indels(self):
@@ -1911,26 +2114,23 @@ class Layout(Categorizer):
         al = self.single_merged_primer_alignment
 
         if al is not None:
-            for i, (kind, length) in enumerate(al.cigar):
-                if kind == sam.BAM_CDEL:
-                    nucs_before = sam.total_reference_nucs(al.cigar[:i])
-                    starts_at = al.reference_start + nucs_before
-
-                    indel = DegenerateDeletion([starts_at], length)
+            ops, lengths, ref_starts, read_starts = cigar_arrays(al)
 
-                elif kind == sam.BAM_CINS:
-                    ref_nucs_before = sam.total_reference_nucs(al.cigar[:i])
-                    starts_after = al.reference_start + ref_nucs_before - 1
+            for i in np.flatnonzero((ops == sam.BAM_CDEL) | (ops == sam.BAM_CINS)):
+                length = int(lengths[i])
 
-                    read_nucs_before = sam.total_read_nucs(al.cigar[:i])
-                    insertion = al.query_sequence[read_nucs_before:read_nucs_before + length]
+                if ops[i] == sam.BAM_CDEL:
+                    starts_at = int(ref_starts[i])
 
-                    indel = DegenerateInsertion([starts_after], [insertion])
+                    indels.append(DegenerateDeletion([starts_at], length))
 
                 else:
-                    continue
+                    starts_after = int(ref_starts[i]) - 1
 
-                indels.append(indel)
+                    read_start = int(read_starts[i])
+                    insertion = al.query_sequence[read_start:read_start + length]
+
+                    indels.append(DegenerateInsertion([starts_after], [insertion]))
 
         return indels
 
@@ -1951,14 +2151,19 @@ class Layout(Categorizer):
         else:
             gap = long_unexplained_gaps[0]
 
+            # Both gap and each alignment's coverage are contiguous, so the amount
+            # of gap left uncovered is its length minus the overlap.
+            starts, ends, _ = self.supplemental_arrays
+            overlaps = np.clip(np.minimum(ends, gap.end) - np.maximum(starts, gap.start) + 1, 0, None)
+            candidates = np.flatnonzero(len(gap) - overlaps <= 3)
+
             covering_als = []
-            for al in self.supplemental_alignments:
-                covered = interval.get_covered(al)
-                if (gap - covered).total_length <= 3:
-                    edit_distance = sam.edit_distance_in_query_interval(al, gap)
-                    error_rate = edit_distance / len(gap)
-                    if error_rate < 0.1:
-                        covering_als.append(al)
+            for i in candidates:
+                al = self.supplemental_alignments[i]
+                edit_distance = sam.edit_distance_in_query_interval(al, gap)
+                error_rate = edit_distance / len(gap)
+                if error_rate < 0.1:
+                    covering_als.append(al)
 
             if len(covering_als) == 0:
                 covering_als = None
@@ -2010,6 +2215,17 @@ class Layout(Categorizer):
         alignments = self.parsimonious_and_gap_alignments + self.parsimonious_donor_alignments + self.min_edit_distance_genomic_insertions
         self.relevant_alignments = interval.make_parsimonious(alignments)
 
+    @memoized_property
+    def one_sided_need_to_cover(self):
+        ''' Part of the read past just the left primer. '''
+        return self.whole_read - self.just_primer_interval['left']
+
+    @memoized_property
+    def two_sided_need_to_cover(self):
+        ''' Part of the read between just the left and right primers. '''
+        primer_interval = self.just_primer_interval
+        return self.whole_read - primer_interval['left'] - primer_interval['right']
+
     @memoized_property
     def one_sided_covering_als(self):
         all_covering_als = {
@@ -2026,29 +2242,33 @@ class Layout(Categorizer):
         else:
             return all_covering_als
 
-        covered = interval.get_covered(primer_al)
+        if primer_al is None:
+            return all_covering_als
 
-        close_to_start = primer_al is not None and covered.start <= 10
+        covered = self.query_covered(primer_al)
+
+        close_to_start = covered.start <= 10
 
         if not close_to_start:
             return all_covering_als
 
+        # Everything past the end of the primer alignment.
+        need_to_cover_past_primer_al = self.whole_read - interval.Interval(0, covered.end)
+
         # from supplementary alignments
 
         has_extra = self.extra_query_in_primer_als['left'] >= 20
 
         if has_extra:
             kind = 'genomic_insertion'
-            primer_interval = interval.get_covered(primer_al)
-            primer_interval.start = 0
+            need_to_cover = need_to_cover_past_primer_al
         else:
             kind = 'nonspecific_amplification'
-            primer_interval = self.just_primer_interval['left']
+            need_to_cover = self.one_sided_need_to_cover
 
-        need_to_cover = self.whole_read - primer_interval
         covering_als = []
         for supp_al in self.supplemental_alignments:
-            if (need_to_cover - interval.get_covered(supp_al)).total_length <= 10:
+            if (need_to_cover - self.query_covered(supp_al)).total_length <= 10:
                 covering_als.append(supp_al)
 
         if covering_als:
@@ -2056,16 +2276,13 @@ class Layout(Categorizer):
 
         # from donor and nh-donor als
 
-        primer_interval = interval.get_covered(primer_al)
-        primer_interval.start = 0
-
-        need_to_cover = self.whole_read - primer_interval
+        need_to_cover = need_to_cover_past_primer_al
         for kind, all_als in [('h', self.parsimonious_donor_alignments),
                               ('nh', self.nonhomologous_donor_alignments),
                              ]:
             covering_als = []
             for al in all_als:
-                if (need_to_cover - interval.get_covered(al)).total_length <= 10:
+                if (need_to_cover - self.query_covered(al)).total_length <= 10:
                     covering_als.append(al)
 
             if covering_als:
@@ -2091,7 +2308,7 @@ class Layout(Categorizer):
             partial_covering_als = []
 
             for al in self.nonhomologous_donor_alignments:
-                covered = interval.get_covered(al)
+                covered = self.query_covered(al)
                 if (gap - covered).total_length <= 2:
                     full_covering_als.append(al)
 
@@ -2130,48 +2347,22 @@ class Layout(Categorizer):
             return best_als
 
     @memoized_property
-    def extra_query_in_primer_als(self):
-        not_primer_length = {'left': 0, 'right': 0}
-
-        if self.strand is None:
-            return not_primer_length
-
-        for target_side in [5, 3]:
-            if (target_side == 5 and self.strand == '+') or (target_side == 3 and self.strand == '-'):
-                read_side = 'left'
-            elif (target_side == 3 and self.strand == '+') or (target_side == 5 and self.strand == '-'):
-                read_side = 'right'
-
-            al = self.primer_alignments[target_side]
-            if al is None:
-                not_primer_length[read_side] = 0
-                continue
-
-            not_primer_interval = self.whole_read - self.just_primer_interval[read_side]
-            not_primer_al = sam.crop_al_to_query_int(al, not_primer_interval.start, not_primer_interval.end)
-            if not_primer_al is None:
-                not_primer_length[read_side] = 0
-            else:
-                not_primer_length[read_side] = not_primer_al.query_alignment_length
-
-        return not_primer_length
-
-    @memoized_property
-    def just_primer_interval(self):
+    def primer_query_analysis(self):
+        ''' Query intervals covered by just the primers on each read side, and
+        how much of each primer alignment extends past its primer, computed together
+        in one pass over the primer alignments.
+        '''
         primer_interval = {'left': None, 'right': None}
+        not_primer_length = {'left': 0, 'right': 0}
 
         if self.strand is None:
-            return primer_interval
+            return primer_interval, not_primer_length
 
         for target_side in [5, 3]:
-            if (target_side == 5 and self.strand == '+') or (target_side == 3 and self.strand == '-'):
-                read_side = 'left'
-            elif (target_side == 3 and self.strand == '+') or (target_side == 5 and self.strand == '-'):
-                read_side = 'right'
+            read_side = READ_SIDE[target_side, self.strand]
 
             al = self.primer_alignments[target_side]
             if al is None:
-                primer_interval[read_side] = None
                 continue
 
             primer = self.target_info.primers_by_side_of_target[target_side]
@@ -2182,7 +2373,20 @@ class Layout(Categorizer):
             elif read_side == 'right':
                 primer_interval[read_side] = interval.Interval(start, len(self.seq) - 1)
 
-        return primer_interval
+            not_primer_interval = self.whole_read - primer_interval[read_side]
+            not_primer_al = sam.crop_al_to_query_int(al, not_primer_interval.start, not_primer_interval.end)
+            if not_primer_al is not None:
+                not_primer_length[read_side] = not_primer_al.query_alignment_length
+
+        return primer_interval, not_primer_length
+
+    @memoized_property
+    def extra_query_in_primer_als(self):
+        return self.primer_query_analysis[1]
+
+    @memoized_property
+    def just_primer_interval(self):
+        return self.primer_query_analysis[0]
 
     @memoized_property
     def nonspecific_amplification(self):
@@ -2190,7 +2394,6 @@ class Layout(Categorizer):
             return None
 
         not_primer_length = self.extra_query_in_primer_als
-        primer_interval = self.just_primer_interval
 
         # If alignments from the primers extend substantially into the read,
         # don't consider this nonspecific amplification.
@@ -2198,11 +2401,11 @@ class Layout(Categorizer):
         if not_primer_length['left'] >= 20 or not_primer_length['right'] >= 20:
             return None
 
-        need_to_cover = self.whole_read - primer_interval['left'] - primer_interval['right']
+        need_to_cover = self.two_sided_need_to_cover
 
         covering_als = []
         for al in self.supplemental_alignments:
-            covered = interval.get_covered(al)
+            covered = self.query_covered(al)
             if len(need_to_cover - covered) < 10:
                 covering_als.append(al)
 
@@ -2223,14 +2426,16 @@ class Layout(Categorizer):
         flattened = [al for source in sources for al in source]
         parsimonious = sam.make_nonredundant(interval.make_parsimonious(flattened))
 
-        covered = interval.get_disjoint_covered(parsimonious)
-        supp_als = []
+        # Entry i is the number of query positions before i covered by parsimonious.
+        covered_counts = np.concatenate([[0], np.cumsum(covered_mask(parsimonious, len(self.seq)))])
 
         def novel_length(supp_al):
-            return (interval.get_covered(supp_al) - covered).total_length
+            supp_covered = self.query_covered(supp_al)
+            already_covered = covered_counts[supp_covered.end + 1] - covered_counts[supp_covered.start]
+            return (supp_covered.end - supp_covered.start + 1) - int(already_covered)
 
         supp_als = interval.make_parsimonious(self.nonredundant_supplemental_alignments)
-        supp_als = sorted(supp_als, key=novel_length, reverse=True)[:10]
+        supp_als = heapq.nlargest(10, supp_als, key=novel_length)
 
         final = parsimonious + supp_als
 
@@ -2334,33 +2539,10 @@ class NonoverlappingPairLayout():
             if als['R1'] is None or als['R2'] is None:
                 continue
 
-            valid_pairs = {}
-            for R1_al, R2_al in itertools.product(als['R1'], als['R2']):
-                if R1_al.reference_name != R2_al.reference_name:
-                    continue
-
-                if sam.get_strand(R1_al) == '+':
-                    if sam.get_strand(R2_al) != '-':
-                        # should be in opposite orientation if concordant
-                        continue
-                    start = R1_al.reference_start
-                    end = R2_al.reference_end
-                elif sam.get_strand(R1_al) == '-':
-                    if sam.get_strand(R2_al) != '+':
-                        continue
-                    start = R2_al.reference_start
-                    end = R1_al.reference_end
-
-                length = end - start
-
-                if 0 < length < 2000:
-                    # Note: multiple valid pairs with same length are discarded.
-                    valid_pairs[length] = {'R1': R1_al, 'R2': R2_al}
-
-            if valid_pairs:
-                length = min(valid_pairs)
-
-                best_pairs[kind] = valid_pairs[length]
+            best_pair = shortest_concordant_pair(als['R1'], als['R2'])
+            if best_pair is not None:
+                i, j = best_pair
+                best_pairs[kind] = {'R1': als['R1'][i], 'R2': als['R2'][j]}
 
         return best_pairs
 
@@ -2477,13 +2659,12 @@ class NonoverlappingPairLayout():
             if als['R1'] is None or als['R2'] is None:
                 continue
 
-            # Note: R2 should be opposite orientation as R1
-            flipped_als = [als['R1'], sam.flip_alignment(als['R2'])]
-            strands = {sam.get_strand(al) for al in flipped_als}
-            if len(strands) > 1:
+            # Note: R2 should be opposite orientation as R1. Compare flags directly
+            # rather than building a flipped copy of R2 just to read its strand.
+            if als['R1'].is_reverse == als['R2'].is_reverse:
                 continue
             else:
-                strand[kind] = strands.pop()
+                strand[kind] = sam.get_strand(als['R1'])
 
         return strand
 
@@ -2529,128 +2710,214 @@ class NonoverlappingPairLayout():
 
         return als
 
+    def register_non_overlapping(self):
+        self.inferred_amplicon_length = -1
+        self.category = 'bad sequence'
+        self.subcategory = 'non-overlapping'
+        self.details = 'n/a'
+        self.relevant_alignments = self.uncategorized_relevant_alignments
+
+    def register_homologous_bridge(self):
+        self.relevant_alignments = {
+            'R1': self.layouts['R1'].parsimonious_target_alignments + self.layouts['R1'].parsimonious_donor_alignments,
+            'R2': self.layouts['R2'].parsimonious_target_alignments + self.layouts['R2'].parsimonious_donor_alignments,
+        }
+
+        junctions = set(self.junctions.values())
+
+        if 'blunt' in junctions and 'uncategorized' not in junctions:
+            self.category = 'blunt misintegration'
+            self.subcategory = f'5\' {self.junctions[5]}, 3\' {self.junctions[3]}'
+            self.details = 'n/a'
+        elif junctions == set(['imperfect', 'HDR']):
+            self.category = 'incomplete HDR'
+            self.subcategory = f'5\' {self.junctions[5]}, 3\' {self.junctions[3]}'
+            self.details = 'n/a'
+        elif junctions == set(['imperfect']):
+            self.category = 'complex misintegration'
+            self.subcategory = 'complex misintegration'
+            self.details = 'n/a'
+        else:
+            self.register_non_overlapping()
+
+    def register_nonhomologous_bridge(self):
+        self.category = 'non-homologous donor'
+        self.subcategory = 'simple'
+        self.details = 'n/a'
+        self.relevant_alignments = {
+            'R1': self.layouts['R1'].parsimonious_target_alignments + self.layouts['R1'].nonhomologous_donor_alignments,
+            'R2': self.layouts['R2'].parsimonious_target_alignments + self.layouts['R2'].nonhomologous_donor_alignments,
+        }
+
+    def register_genomic_bridge(self, kind, register):
+        R1_primer = self.layouts['R1'].primer_alignments[5]
+        R2_primer = self.layouts['R2'].primer_alignments[3]
+
+        if R1_primer is not None and R2_primer is not None:
+            register()
+
+            bridging_als = self.bridging_alignments[kind]
+            self.relevant_alignments = {
+                'R1': [R1_primer, bridging_als['R1']],
+                'R2': [R2_primer, bridging_als['R2']],
+            }
+        else:
+            self.register_non_overlapping()
+
+    # Which register_* method handles each successful bridging kind.
+    bridge_registrations = {
+        'h': lambda layout: layout.register_homologous_bridge(),
+        'nh': lambda layout: layout.register_nonhomologous_bridge(),
+        'nonspecific_amplification': lambda layout: layout.register_genomic_bridge('nonspecific_amplification', layout.register_nonspecific_amplification),
+        'genomic_insertion': lambda layout: layout.register_genomic_bridge('genomic_insertion', layout.register_genomic_insertion),
+    }
+
     def categorize(self):
         kind = self.successful_bridging_kind
-        if kind == 'h' and self.possible_inferred_amplicon_length > 0:
+        register = self.bridge_registrations.get(kind)
+
+        if register is not None and self.possible_inferred_amplicon_length > 0:
+            # Registration may still fall back to register_non_overlapping,
+            # which resets this to -1.
             self.inferred_amplicon_length = self.possible_inferred_amplicon_length
+            register(self)
+        else:
+            self.register_non_overlapping()
 
-            self.relevant_alignments = {
-                'R1': self.layouts['R1'].parsimonious_target_alignments + self.layouts['R1'].parsimonious_donor_alignments,
-                'R2': self.layouts['R2'].parsimonious_target_alignments + self.layouts['R2'].parsimonious_donor_alignments,
-            }
+        #if self.strand == '-':
+        #    self.relevant_alignments = {
+        #        'R1': self.relevant_alignments['R2'],
+        #        'R2': self.relevant_alignments['R1'],
+        #    }
 
-            junctions = set(self.junctions.values())
+        return self.category, self.subcategory, self.details
 
-            if 'blunt' in junctions and 'uncategorized' not in junctions:
-                self.category = 'blunt misintegration'
-                self.subcategory = f'5\' {self.junctions[5]}, 3\' {self.junctions[3]}'
-                self.details = 'n/a'
-            elif junctions == set(['imperfect', 'HDR']):
-                self.category = 'incomplete HDR'
-                self.subcategory = f'5\' {self.junctions[5]}, 3\' {self.junctions[3]}'
-                self.details = 'n/a'
-            elif junctions == set(['imperfect']):
-                self.category = 'complex misintegration'
-                self.subcategory = 'complex misintegration'
-                self.details = 'n/a'
+def cigar_arrays(al):
+    ''' Returns al's CIGAR as arrays of operations and lengths, along with the
+    reference and read positions at which each operation starts.
+    '''
+    ops, lengths = np.array(al.cigartuples, dtype=int).reshape(-1, 2).T
 
-            else:
-                self.inferred_amplicon_length = -1
-                self.category = 'bad sequence'
-                self.subcategory = 'non-overlapping'
-                self.details = 'n/a'
-                self.relevant_alignments = self.uncategorized_relevant_alignments
+    ref_lengths = np.where(np.isin(ops, REF_CONSUMING_OPS), lengths, 0)
+    read_lengths = np.where(np.isin(ops, READ_CONSUMING_OPS), lengths, 0)
 
-        elif kind == 'nh' and self.possible_inferred_amplicon_length > 0:
-            self.inferred_amplicon_length = self.possible_inferred_amplicon_length
+    ref_starts = al.reference_start + np.cumsum(ref_lengths) - ref_lengths
+    read_starts = np.cumsum(read_lengths) - read_lengths
 
-            self.category = 'non-homologous donor'
-            self.subcategory = 'simple'
-            self.details = 'n/a'
-            self.relevant_alignments = {
-                'R1': self.layouts['R1'].parsimonious_target_alignments + self.layouts['R1'].nonhomologous_donor_alignments,
-                'R2': self.layouts['R2'].parsimonious_target_alignments + self.layouts['R2'].nonhomologous_donor_alignments,
-            }
+    return ops, lengths, ref_starts, read_starts
 
-        elif kind == 'nonspecific_amplification' and self.possible_inferred_amplicon_length > 0:
-            R1_primer = self.layouts['R1'].primer_alignments[5]
-            R2_primer = self.layouts['R2'].primer_alignments[3]
+@lru_cache(maxsize=128)
+def single_reference_header(name, length):
+    ''' Header with a single reference, reused across reads instead of rebuilt for each one. '''
+    return pysam.AlignmentHeader.from_references([name], [length])
 
-            if R1_primer is not None and R2_primer is not None:
-                self.inferred_amplicon_length = self.possible_inferred_amplicon_length
+def shortest_concordant_pair(R1_als, R2_als, max_length=2000):
+    ''' Indices (i, j) of the concordant pair of R1_als[i] and R2_als[j] that implies the
+    shortest fragment length in (0, max_length), or None if there isn't one.
+    Concordant means on the same reference in opposite orientations.
+    If several pairs tie for shortest, the last one in product order is returned.
+    '''
+    ref_codes = {}
+    def arrays(als):
+        codes = np.array([ref_codes.setdefault(al.reference_name, len(ref_codes)) for al in als], dtype=int)
+        reverse = np.array([al.is_reverse for al in als], dtype=bool)
+        starts = np.array([al.reference_start for al in als], dtype=int)
+        ends = np.array([al.reference_end for al in als], dtype=int)
+        return codes, reverse, starts, ends
+
+    R1_codes, R1_reverse, R1_starts, R1_ends = arrays(R1_als)
+    R2_codes, R2_reverse, R2_starts, R2_ends = arrays(R2_als)
+
+    # Rows are R1 alignments, columns are R2 alignments.
+    lengths = np.where(R1_reverse[:, None],
+                       R1_ends[:, None] - R2_starts[None, :],
+                       R2_ends[None, :] - R1_starts[:, None],
+                      )
+
+    valid = ((R1_codes[:, None] == R2_codes[None, :]) &
+             (R1_reverse[:, None] != R2_reverse[None, :]) &
+             (lengths > 0) &
+             (lengths < max_length)
+            )
 
-                self.register_nonspecific_amplification()
+    if not valid.any():
+        return None
 
-                bridging_als = self.bridging_alignments['nonspecific_amplification']
-                self.relevant_alignments = {
-                    'R1': [R1_primer, bridging_als['R1']],
-                    'R2': [R2_primer, bridging_als['R2']],
-                }
+    shortest = lengths[valid].min()
+    i, j = np.unravel_index(np.flatnonzero(valid & (lengths == shortest))[-1], valid.shape)
 
-            else:
-                self.inferred_amplicon_length = -1
-                self.category = 'bad sequence'
-                self.subcategory = 'non-overlapping'
-                self.details = 'n/a'
-                self.relevant_alignments = self.uncategorized_relevant_alignments
+    return int(i), int(j)
 
-        elif kind == 'genomic_insertion' and self.possible_inferred_amplicon_length > 0:
-            R1_primer = self.layouts['R1'].primer_alignments[5]
-            R2_primer = self.layouts['R2'].primer_alignments[3]
+def covered_mask(als, query_length):
+    ''' Boolean array over query positions that is True where any of als is aligned. '''
+    covered = np.zeros(query_length, dtype=bool)
+    for al in als:
+        al_covered = interval.get_covered(al)
+        covered[al_covered.start:al_covered.end + 1] = True
 
-            if R1_primer is not None and R2_primer is not None:
-                self.inferred_amplicon_length = self.possible_inferred_amplicon_length
+    return covered
 
-                self.register_genomic_insertion()
+def max_indels_nearby(alignment, ref_pos, window):
+    ''' Lengths of the longest deletion and the longest insertion near ref_pos,
+    found together from one decoding of alignment's CIGAR.
+    Deletions count if they overlap reference positions [ref_pos - window, ref_pos + window).
+    Insertions count if they would survive cropping alignment to reference
+    positions [ref_pos - window, ref_pos + window].
+    '''
+    start, end = ref_pos - window, ref_pos + window
 
-                bridging_als = self.bridging_alignments['genomic_insertion']
-                self.relevant_alignments = {
-                    'R1': [R1_primer, bridging_als['R1']],
-                    'R2': [R2_primer, bridging_als['R2']],
-                }
-            else:
-                self.inferred_amplicon_length = -1
-                self.category = 'bad sequence'
-                self.subcategory = 'non-overlapping'
-                self.details = 'n/a'
-                self.relevant_alignments = self.uncategorized_relevant_alignments
+    if alignment.reference_start > end or alignment.reference_end - 1 < start:
+        # Deletions lie inside the aligned reference span, so an alignment
+        # that doesn't reach the window can't have anything nearby.
+        return 0, 0
 
-        else:
-            self.inferred_amplicon_length = -1
-            self.category = 'bad sequence'
-            self.subcategory = 'non-overlapping'
-            self.details = 'n/a'
-            self.relevant_alignments = self.uncategorized_relevant_alignments
+    ops, lengths, ref_starts, read_starts = cigar_arrays(alignment)
 
-        #if self.strand == '-':
-        #    self.relevant_alignments = {
-        #        'R1': self.relevant_alignments['R2'],
-        #        'R2': self.relevant_alignments['R1'],
-        #    }
+    dels_nearby = ((ops == sam.BAM_CDEL) &
+                   (ref_starts < end) &
+                   (ref_starts + lengths > start)
+                  )
 
-        return self.category, self.subcategory, self.details
+    is_ins = ops == sam.BAM_CINS
 
-def max_del_nearby(alignment, ref_pos, window):
-    ref_pos_to_block = sam.get_ref_pos_to_block(alignment)
-    nearby = range(ref_pos - window, ref_pos + window)
-    blocks = [ref_pos_to_block.get(r, (-1, -1, -1)) for r in nearby]
-    dels = [l for k, l, s in blocks if k == sam.BAM_CDEL]
-    if dels:
-        max_del = max(dels)
+    if alignment.reference_start >= start and alignment.reference_end - 1 <= end:
+        # Entirely contained, so cropping would keep every insertion.
+        ins_nearby = is_ins
     else:
-        max_del = 0
+        # Cropping keeps an insertion only if it is flanked by aligned bases
+        # inside the interval: the last one before it and the first one after it.
+        is_aligned = np.isin(ops, [sam.BAM_CMATCH, sam.BAM_CEQUAL, sam.BAM_CDIFF])
+        indices = np.arange(len(ops))
+
+        prev_aligned = np.maximum.accumulate(np.where(is_aligned, indices, -1))
+        next_aligned = np.minimum.accumulate(np.where(is_aligned, indices, len(ops))[::-1])[::-1]
+
+        has_prev = prev_aligned >= 0
+        has_next = next_aligned < len(ops)
+
+        last_ref_before = (ref_starts + lengths - 1)[np.where(has_prev, prev_aligned, 0)]
+        first_ref_after = ref_starts[np.where(has_next, next_aligned, 0)]
+
+        ins_nearby = is_ins & has_prev & has_next & (last_ref_before >= start) & (first_ref_after <= end)
 
+    max_del = int(lengths[dels_nearby].max()) if dels_nearby.any() else 0
+    max_ins = int(lengths[ins_nearby].max()) if ins_nearby.any() else 0
+
+    return max_del, max_ins
+
+def max_del_nearby(alignment, ref_pos, window):
+    max_del, max_ins = max_indels_nearby(alignment, ref_pos, window)
     return max_del
 
 def max_ins_nearby(alignment, ref_pos, window):
-    nearby = sam.crop_al_to_ref_int(alignment, ref_pos - window, ref_pos + window)
-    max_ins = sam.max_block_length(nearby, {sam.BAM_CINS})
+    if alignment is None:
+        return 0
+
+    max_del, max_ins = max_indels_nearby(alignment, ref_pos, window)
     return max_ins
 
 def max_indel_nearby(alignment, ref_pos, window):
-    max_del = max_del_nearby(alignment, ref_pos, window)
-    max_ins = max_ins_nearby(alignment, ref_pos, window)
-    return max(max_del, max_ins)
+    return max(max_indels_nearby(alignment, ref_pos, window))
 
 def get_mismatch_info(alignment, reference_sequences):
     mismatches = []
@@ -2689,21 +2956,26 @@ def get_mismatch_info(alignment, reference_sequences):
 
 def get_indel_info(alignment):
     indels = []
-    for i, (kind, length) in enumerate(alignment.cigar):
+
+    ops, lengths, ref_starts, read_starts = cigar_arrays(alignment)
+
+    is_indel = (ops == sam.BAM_CDEL) | (ops == sam.BAM_CREF_SKIP) | (ops == sam.BAM_CINS)
+
+    for kind, length, read_nucs_before in zip(ops[is_indel].tolist(), lengths[is_indel].tolist(), read_starts[is_indel].tolist()):
         if kind == sam.BAM_CDEL or kind == sam.BAM_CREF_SKIP:
             if kind == sam.BAM_CDEL:
                 name = 'deletion'
             else:
                 name = 'splicing'
 
-            nucs_before = sam.total_read_nucs(alignment.cigar[:i])
+            nucs_before = read_nucs_before
             centered_at = np.mean([sam.true_query_position(p, alignment) for p in [nucs_before - 1, nucs_before]])
 
             indels.append((name, (centered_at, length)))
 
-        elif kind == sam.BAM_CINS:
+        else:
             # Note: edges are both inclusive.
-            first_edge = sam.total_read_nucs(alignment.cigar[:i])
+            first_edge = read_nucs_before
             second_edge = first_edge + length - 1
             starts_at, ends_at = sorted(sam.true_query_position(p, alignment) for p in [first_edge, second_edge])
             indels.append(('insertion', (starts_at, ends_at)))
@@ -2772,7 +3044,7 @@ def split_at_edit_clusters(al, reference_sequences, num_edits=5, window_size=11)
                 break
 
         if first_read_p_in_after is not None:
-            cropped_after = sam.crop_al_to_query_int(al, first_read_p_in_after, np.inf)
+            cropped_after = sam.crop_al_to_query_int(al, first_read_p_in_after, sys.maxsize)
             if cropped_after is not None:
                 split_als.extend(split_at_edit_clusters(cropped_after, reference_sequences))
 
@@ -2799,13 +3071,10 @@ def crop_terminal_mismatches(al, reference_sequences):
 
     return cropped_al
 
-def comprehensively_split_alignment(al, target_info, mode, ins_size_to_split_at=None, del_size_to_split_at=None):
+def iter_comprehensively_split_alignment(al, target_info, mode, ins_size_to_split_at=None, del_size_to_split_at=None):
     ''' It is easier to reason about alignments if any that contain long insertions, long deletions, or clusters
     of many edits are split into multiple alignments.
     '''
-
-    split_als = []
-
     if mode == 'illumina':
         if ins_size_to_split_at is None:
             ins_size_to_split_at = 3
@@ -2818,7 +3087,7 @@ def comprehensively_split_alignment(al, target_info, mode, ins_size_to_split_at=
                 for split_3 in sam.split_at_large_insertions(split_2, ins_size_to_split_at):
                     cropped_al = crop_terminal_mismatches(split_3, target_info.reference_sequences)
                     if cropped_al is not None and cropped_al.query_alignment_length >= 5:
-                        split_als.append(cropped_al)
+                        yield cropped_al
 
     elif mode == 'pacbio':
         # Empirically, for Pacbio data, it is hard to find a threshold for number of edits within a window that
@@ -2838,16 +3107,29 @@ def comprehensively_split_alignment(al, target_info, mode, ins_size_to_split_at=
                     # Then at longer indels anywhere.
                     for split_3 in sam.split_at_deletions(split_2, 10):
                         for split_4 in sam.split_at_large_insertions(split_3, 10):
-                            split_als.append(split_4)
+                            yield split_4
         else:
             for split_1 in sam.split_at_deletions(al, del_size_to_split_at):
                 for split_2 in sam.split_at_large_insertions(split_1, ins_size_to_split_at):
-                    split_als.append(split_2)
+                    yield split_2
 
     else:
         raise ValueError(mode)
 
-    return split_als
+def comprehensively_split_alignment(al, target_info, mode, ins_size_to_split_at=None, del_size_to_split_at=None):
+    return list(iter_comprehensively_split_alignment(al, target_info, mode, ins_size_to_split_at, del_size_to_split_at))
+
+def split_and_extend_alignment(al, target_info, mode, ins_size_to_split_at=None, del_size_to_split_at=None):
+    ''' Comprehensively split al and extend each piece, streaming each alignment
+    through both steps instead of materializing the split list first.
+    '''
+    seq_bytes = target_info.reference_sequence_bytes[al.reference_name]
+    for split_al in iter_comprehensively_split_alignment(al, target_info, mode, ins_size_to_split_at, del_size_to_split_at):
+        # Pieces with no soft clipping on either end have nothing to extend into.
+        if split_al.query_alignment_start == 0 and split_al.query_alignment_end == split_al.query_length:
+            yield split_al
+        else:
+            yield sw.extend_alignment(split_al, seq_bytes)
 
 def junction_microhomology(reference_sequences, first_al, second_al):
     if first_al is None or second_al is None:
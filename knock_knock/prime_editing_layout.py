@@ -1,10 +1,10 @@
 from collections import Counter, defaultdict
+from functools import cached_property as memoized_property
 
 import numpy as np
 import pysam
 
 from hits import interval, sam, utilities, sw, fastq
-from hits.utilities import memoized_property
 
 import knock_knock.pegRNAs
 import knock_knock.target_info
@@ -875,16 +875,12 @@ class Layout(layout.Categorizer):
             initial_als.append(self.perfect_right_edge_alignment)
 
         for al in initial_als:
-            split_als = layout.comprehensively_split_alignment(al,
-                                                               self.target_info,
-                                                               'illumina',
-                                                               self.ins_size_to_split_at,
-                                                               self.del_size_to_split_at,
-                                                              )
-
-            seq_bytes = self.target_info.reference_sequence_bytes[al.reference_name]
-
-            extended = [sw.extend_alignment(split_al, seq_bytes) for split_al in split_als]
+            extended = layout.split_and_extend_alignment(al,
+                                                         self.target_info,
+                                                         'illumina',
+                                                         self.ins_size_to_split_at,
+                                                         self.del_size_to_split_at,
+                                                        )
 
             all_split_als.extend(extended)
 
@@ -926,15 +922,12 @@ class Layout(layout.Categorizer):
         if split:
             all_split_als = []
             for al in alignments:
-                split_als = layout.comprehensively_split_alignment(al,
-                                                                   self.target_info,
-                                                                   'illumina',
-                                                                   self.ins_size_to_split_at,
-                                                                   self.del_size_to_split_at,
-                                                                  )
-                
-                target_seq_bytes = self.target_info.reference_sequences[al.reference_name].encode()
-                extended = [sw.extend_alignment(split_al, target_seq_bytes) for split_al in split_als]
+                extended = layout.split_and_extend_alignment(al,
+                                                             self.target_info,
+                                                             'illumina',
+                                                             self.ins_size_to_split_at,
+                                                             self.del_size_to_split_at,
+                                                            )
 
                 all_split_als.extend(extended)
         else:
@@ -755,6 +755,15 @@ class TargetInfo():
 
         return around_cuts
 
+    @memoized_with_args
+    def around_cuts_mask(self, each_side):
+        ''' Boolean array over target positions that is True within around_cuts(each_side). '''
+        mask = np.zeros(len(self.target_sequence), dtype=bool)
+        for cut_after in self.cut_afters.values():
+            mask[max(cut_after - each_side + 1, 0):cut_after + each_side + 1] = True
+
+        return mask
+
     @memoized_with_args
     def not_around_cuts(self, each_side):
         whole_target = interval.Interval(0, len(self.target_sequence))
@@ -1719,14 +1728,22 @@ class TargetInfo():
 
         return offset
 
-    def remove_organism_from_alignment(self, al):
-        organism, original_name = al.reference_name.split('_', 1)
-        organism_matches = {n for n in self.supplemental_headers if al.reference_name.startswith(n)}
+    @memoized_with_args
+    def organism_of_reference_name(self, reference_name):
+        ''' Classify a supplemental reference name by its organism prefix.
+        Done once per name rather than once per alignment.
+        '''
+        organism_matches = {n for n in self.supplemental_headers if reference_name.startswith(n)}
         if len(organism_matches) != 1:
-            raise ValueError(al.reference_name, self.supplemental_headers)
+            raise ValueError(reference_name, self.supplemental_headers)
         else:
             organism = organism_matches.pop()
-            original_name = al.reference_name[len(organism) + 1:]
+            original_name = reference_name[len(organism) + 1:]
+
+        return organism, original_name
+
+    def remove_organism_from_alignment(self, al):
+        organism, original_name = self.organism_of_reference_name(al.reference_name)
 
         header = self.supplemental_headers[organism]
         al_dict = al.to_dict()
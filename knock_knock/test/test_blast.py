@@ -0,0 +1,144 @@
+import random
+import shutil
+
+import pysam
+import pytest
+
+from hits import fastq, utilities
+
+import knock_knock.blast
+
+requires_blastn = pytest.mark.skipif(shutil.which('blastn') is None, reason='blastn not installed')
+
+def make_reads():
+    rng = random.Random(0)
+
+    # No T in the reference and only A and T in reads meant to be unaligned,
+    # so that neither strand of those reads can align by chance.
+    ref_seq = ''.join(rng.choice('ACG') for _ in range(1000))
+
+    reads = []
+    for i in range(20):
+        start = rng.randint(0, len(ref_seq) - 100)
+        seq = ref_seq[start:start + 100]
+        if i % 2 == 1:
+            seq = utilities.reverse_complement(seq)
+
+        # Unrelated flanking sequence, so that alignments are clipped.
+        flank = ''.join(rng.choice('ACGT') for _ in range(10))
+        seq = flank + seq
+
+        reads.append(fastq.Read(f'aligned_{i}', seq, 'I' * len(seq)))
+
+    for i in range(3):
+        seq = ''.join(rng.choice('AT') for _ in range(100))
+        reads.append(fastq.Read(f'unaligned_{i}', seq, 'I' * len(seq)))
+
+    return {'ref': ref_seq}, reads
+
+@requires_blastn
+def test_blast(tmp_path):
+    ref_seqs, reads = make_reads()
+    reads_by_name = {read.name: read for read in reads}
+
+    results = {}
+
+    for num_threads in [1, 2]:
+        bam_fn = tmp_path / f'aligned.{num_threads}.bam'
+        bam_by_name_fn = tmp_path / f'by_name.{num_threads}.bam'
+
+        knock_knock.blast.blast(ref_seqs, iter(reads), bam_fn, bam_by_name_fn, num_threads=num_threads)
+
+        with pysam.AlignmentFile(bam_fn) as bam_fh:
+            assert bam_fh.header['HD']['SO'] == 'coordinate'
+            assert bam_fh.has_index()
+
+            aligned = list(bam_fh)
+
+        with pysam.AlignmentFile(bam_by_name_fn) as bam_fh:
+            assert bam_fh.header['HD']['SO'] == 'queryname'
+            by_name = list(bam_fh)
+
+        starts = [al.reference_start for al in aligned]
+        assert starts == sorted(starts)
+
+        assert {al.query_name for al in aligned} == {read.name for read in reads if read.name.startswith('aligned')}
+
+        for al in aligned:
+            # Hard clipping from blastn is converted to soft clipping, so
+            # every alignment carries the full read.
+            assert all(kind != pysam.CHARD_CLIP for kind, length in al.cigartuples)
+
+            read = reads_by_name[al.query_name]
+            expected_seq = utilities.reverse_complement(read.seq) if al.is_reverse else read.seq
+            assert al.query_sequence == expected_seq
+            assert al.query_length == len(read)
+
+        # Records for each name are contiguous, and every read is present,
+        # with reads that didn't align as unmapped records.
+        names_in_order = [name for name, _ in utilities.group_by(by_name, lambda al: al.query_name)]
+        assert len(names_in_order) == len(set(names_in_order))
+        assert set(names_in_order) == set(reads_by_name)
+
+        for al in by_name:
+            assert al.is_unmapped == al.query_name.startswith('unaligned')
+
+        # Tags like e-values may depend on how much sequence each blastn
+        # process saw, so only placements are compared.
+        def placements(als):
+            return sorted((al.query_name, al.is_unmapped, al.is_reverse, al.reference_start, al.cigarstring) for al in als)
+
+        results[num_threads] = (placements(aligned), placements(by_name))
+
+    # Sharding reads across blastn processes doesn't change the alignments.
+    assert results[1] == results[2]
+
+def test_blast_no_reads(tmp_path):
+    ref_seqs, _ = make_reads()
+
+    bam_fn = tmp_path / 'aligned.bam'
+    bam_by_name_fn = tmp_path / 'by_name.bam'
+
+    # With no reads, no blastn process is started at all.
+    knock_knock.blast.blast(ref_seqs, iter([]), bam_fn, bam_by_name_fn, num_threads=4)
+
+    for fn in [bam_fn, bam_by_name_fn]:
+        with pysam.AlignmentFile(fn) as bam_fh:
+            assert list(bam_fh.references) == ['ref']
+            assert list(bam_fh) == []
+
+def test_blast_empty_reads(tmp_path):
+    ref_seqs, _ = make_reads()
+    reads = [fastq.Read(f'empty_{i}', '', '') for i in range(3)]
+
+    bam_fn = tmp_path / 'aligned.bam'
+    bam_by_name_fn = tmp_path / 'by_name.bam'
+
+    # Reads without sequence are never sent to blastn, so none is started,
+    # but they are still reported as unaligned.
+    knock_knock.blast.blast(ref_seqs, iter(reads), bam_fn, bam_by_name_fn, num_threads=2)
+
+    with pysam.AlignmentFile(bam_fn) as bam_fh:
+        assert list(bam_fh) == []
+
+    with pysam.AlignmentFile(bam_by_name_fn) as bam_fh:
+        by_name = list(bam_fh)
+
+    assert sorted(al.query_name for al in by_name) == [read.name for read in reads]
+    assert all(al.is_unmapped for al in by_name)
+
+def test_fastq_records(tmp_path):
+    fastq_fn = tmp_path / 'reads.fastq'
+    fastq_fn.write_text('@first comment\nACGT\n+\nIIII\n@second\nAC\n+\nII\n')
+
+    records = list(knock_knock.blast.fastq_records(fastq_fn))
+    assert records == [(b'first', b'ACGT', b'IIII'), (b'second', b'AC', b'II')]
+
+    for contents in ['@first\nACGT\n+\nIIII\n@second\nAC\n',
+                     '@first\nACGT\n-\nIIII\n',
+                     '@\nACGT\n+\nIIII\n',
+                    ]:
+        fastq_fn.write_text(contents)
+
+        with pytest.raises(ValueError):
+            list(knock_knock.blast.fastq_records(fastq_fn))
@@ -0,0 +1,274 @@
+'''
+Checks that vectorized helpers in layout and target_info agree with the
+straightforward implementations they replaced.
+'''
+
+import gc
+import itertools
+import random
+import weakref
+from pathlib import Path
+
+import numpy as np
+import pysam
+import pytest
+import yaml
+
+import hits.sam
+from hits import interval, sam, sw
+
+import knock_knock.layout
+import knock_knock.target_info
+
+base_dir = Path(__file__).parent
+
+header = pysam.AlignmentHeader.from_references(['first', 'second'], [100000, 100000])
+
+def random_alignment(rng, reference_start=None, reference_id=0, is_reverse=False, max_ops=6):
+    ''' Alignment with a random CIGAR of soft clips, matches, insertions, and deletions. '''
+    cigar = []
+
+    if rng.random() < 0.5:
+        cigar.append((sam.BAM_CSOFT_CLIP, rng.randint(1, 5)))
+
+    cigar.append((sam.BAM_CMATCH, rng.randint(1, 8)))
+
+    for _ in range(rng.randint(0, max_ops)):
+        op = rng.choice([sam.BAM_CMATCH, sam.BAM_CINS, sam.BAM_CDEL])
+        if op != cigar[-1][0]:
+            cigar.append((op, rng.randint(1, 8)))
+
+    if cigar[-1][0] != sam.BAM_CMATCH:
+        cigar.append((sam.BAM_CMATCH, rng.randint(1, 5)))
+
+    if rng.random() < 0.5:
+        cigar.append((sam.BAM_CSOFT_CLIP, rng.randint(1, 5)))
+
+    query_length = sum(length for op, length in cigar if op in (sam.BAM_CMATCH, sam.BAM_CINS, sam.BAM_CSOFT_CLIP))
+
+    if reference_start is None:
+        reference_start = rng.randint(50, 70)
+
+    al = pysam.AlignedSegment(header)
+    al.query_name = 'query'
+    al.reference_id = reference_id
+    al.reference_start = reference_start
+    al.is_reverse = is_reverse
+    al.query_sequence = ''.join(rng.choice('ACGT') for _ in range(query_length))
+    al.query_qualities = [30] * query_length
+    al.cigartuples = cigar
+
+    return al
+
+def cigar_arrays_by_walking(al):
+    ops, lengths, ref_starts, read_starts = [], [], [], []
+
+    ref_p = al.reference_start
+    read_p = 0
+
+    for op, length in al.cigartuples:
+        ops.append(op)
+        lengths.append(length)
+        ref_starts.append(ref_p)
+        read_starts.append(read_p)
+
+        if op in knock_knock.layout.REF_CONSUMING_OPS:
+            ref_p += length
+
+        if op in knock_knock.layout.READ_CONSUMING_OPS:
+            read_p += length
+
+    return ops, lengths, ref_starts, read_starts
+
+def max_del_nearby_by_blocks(alignment, ref_pos, window):
+    ref_pos_to_block = sam.get_ref_pos_to_block(alignment)
+    nearby = range(ref_pos - window, ref_pos + window)
+    blocks = [ref_pos_to_block.get(r, (-1, -1, -1)) for r in nearby]
+    dels = [l for k, l, s in blocks if k == sam.BAM_CDEL]
+    if dels:
+        max_del = max(dels)
+    else:
+        max_del = 0
+
+    return max_del
+
+def max_ins_nearby_by_cropping(alignment, ref_pos, window):
+    nearby = sam.crop_al_to_ref_int(alignment, ref_pos - window, ref_pos + window)
+    return sam.max_block_length(nearby, {sam.BAM_CINS})
+
+def shortest_concordant_pair_by_product(R1_als, R2_als, max_length=2000):
+    valid_pairs = {}
+    for R1_al, R2_al in itertools.product(R1_als, R2_als):
+        if R1_al.reference_name != R2_al.reference_name:
+            continue
+
+        if sam.get_strand(R1_al) == '+':
+            if sam.get_strand(R2_al) != '-':
+                continue
+            start = R1_al.reference_start
+            end = R2_al.reference_end
+        else:
+            if sam.get_strand(R2_al) != '+':
+                continue
+            start = R2_al.reference_start
+            end = R1_al.reference_end
+
+        length = end - start
+
+        if 0 < length < max_length:
+            valid_pairs[length] = (R1_al, R2_al)
+
+    if valid_pairs:
+        return valid_pairs[min(valid_pairs)]
+    else:
+        return None
+
+def load_read_set(set_name):
+    details = yaml.safe_load((base_dir / 'read_sets' / set_name / 'expected_values.yaml').read_text())
+    ti = knock_knock.target_info.TargetInfo(base_dir,
+                                            details['target_info'],
+                                            **details.get('target_info_kwargs', {}),
+                                           )
+    bam_fn = base_dir / 'read_sets' / set_name / 'alignments.bam'
+    return ti, bam_fn
+
+def test_cigar_arrays():
+    rng = random.Random(0)
+
+    for _ in range(500):
+        al = random_alignment(rng)
+        expected = cigar_arrays_by_walking(al)
+        actual = knock_knock.layout.cigar_arrays(al)
+
+        for expected_array, actual_array in zip(expected, actual):
+            assert list(actual_array) == expected_array, al.cigarstring
+
+def test_max_indels_nearby():
+    rng = random.Random(0)
+
+    for _ in range(2000):
+        al = random_alignment(rng)
+
+        for _ in range(5):
+            ref_pos = rng.randint(40, 130)
+            window = rng.randint(1, 12)
+
+            max_del, max_ins = knock_knock.layout.max_indels_nearby(al, ref_pos, window)
+
+            context = (al.cigarstring, al.reference_start, ref_pos, window)
+            assert max_del == max_del_nearby_by_blocks(al, ref_pos, window), context
+            assert max_ins == max_ins_nearby_by_cropping(al, ref_pos, window), context
+
+def test_shortest_concordant_pair():
+    rng = random.Random(0)
+
+    def random_als():
+        return [random_alignment(rng,
+                                 reference_start=rng.randint(0, 3000),
+                                 reference_id=rng.randint(0, 1),
+                                 is_reverse=rng.random() < 0.5,
+                                )
+                for _ in range(rng.randint(0, 6))
+               ]
+
+    for _ in range(1000):
+        R1_als = random_als()
+        R2_als = random_als()
+
+        expected = shortest_concordant_pair_by_product(R1_als, R2_als)
+        actual = knock_knock.layout.shortest_concordant_pair(R1_als, R2_als)
+
+        if expected is None:
+            assert actual is None
+        else:
+            i, j = actual
+            assert R1_als[i] is expected[0]
+            assert R2_als[j] is expected[1]
+
+def test_covered_mask():
+    rng = random.Random(0)
+
+    for _ in range(500):
+        als = [random_alignment(rng) for _ in range(rng.randint(0, 4))]
+        query_length = max([al.query_length for al in als], default=10)
+
+        expected = np.zeros(query_length, dtype=bool)
+        for covered in interval.get_disjoint_covered(als).intervals:
+            expected[covered.start:covered.end + 1] = True
+
+        actual = knock_knock.layout.covered_mask(als, query_length)
+
+        assert list(actual) == list(expected)
+
+def test_around_cuts_mask():
+    for set_name in ['PMID31634902_fig_4G_HEK3_del1-80', 'PMID34887556_Fig2E_HEK3_PD_90_standard_1']:
+        ti, _ = load_read_set(set_name)
+
+        for each_side in [1, 10, 50]:
+            around_cuts = ti.around_cuts(each_side)
+            mask = ti.around_cuts_mask(each_side)
+
+            assert len(mask) == len(ti.target_sequence)
+
+            for p in range(len(ti.target_sequence)):
+                assert mask[p] == (p in around_cuts), (set_name, each_side, p)
+
+def test_split_and_extend_alignment():
+    num_compared = 0
+
+    for set_name in ['PMID31634902_fig_4G_HEK3_del1-80', 'PMID34887556_Fig2E_HEK3_PD_90_standard_1']:
+        ti, bam_fn = load_read_set(set_name)
+
+        for qname, als in hits.sam.grouped_by_name(bam_fn):
+            for al in als:
+                if al.is_unmapped or al.reference_name not in ti.reference_sequence_bytes:
+                    continue
+
+                seq_bytes = ti.reference_sequence_bytes[al.reference_name]
+
+                for mode in ['illumina', 'pacbio']:
+                    expected = [sw.extend_alignment(split_al, seq_bytes)
+                                for split_al in knock_knock.layout.comprehensively_split_alignment(al, ti, mode)
+                               ]
+                    actual = list(knock_knock.layout.split_and_extend_alignment(al, ti, mode))
+
+                    assert [a.to_string() for a in actual] == [e.to_string() for e in expected], (set_name, qname, mode)
+
+                    num_compared += 1
+
+    assert num_compared > 0
+
+def test_edge_r_without_integration():
+    ti, bam_fn = load_read_set('PMID31634902_fig_4G_HEK3_del1-5')
+
+    num_without_integration = 0
+
+    for qname, als in hits.sam.grouped_by_name(bam_fn):
+        layout = knock_knock.layout.Layout(als, ti)
+
+        if layout.integration_interval is None:
+            assert layout.edge_r == (None, None), qname
+            num_without_integration += 1
+
+    assert num_without_integration > 0
+
+def test_per_class_category_lookups():
+    class Categorizer(knock_knock.layout.Categorizer):
+        category_order = [
+            ('first', ('a', 'b')),
+            ('second', ('c',)),
+        ]
+
+    assert Categorizer.categories() == ('first', 'second')
+    assert Categorizer.order(('second', 'c')) == (1, 0)
+    assert Categorizer.categories() != knock_knock.layout.Layout.categories()
+
+    # Shared values can't be corrupted by callers.
+    with pytest.raises(TypeError):
+        Categorizer.subcategories()['first'] = ()
+
+    # Cached values don't keep dynamically created classes alive.
+    categorizer_ref = weakref.ref(Categorizer)
+    del Categorizer
+    gc.collect()
+    assert categorizer_ref() is None
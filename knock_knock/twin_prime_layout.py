@@ -1,8 +1,8 @@
 from collections import defaultdict
+from functools import cached_property as memoized_property
 
 import hits.visualize
 from hits import interval, sam
-from hits.utilities import memoized_property
 
 import knock_knock.layout
 import knock_knock.pegRNAs
@@ -8,7 +8,7 @@ if 'inline' not in matplotlib.get_backend():
 import numpy as np
 import matplotlib.pyplot as plt
 
-from hits import utilities, interval, sam, sw
+from hits import utilities, interval, sam
 import hits.visualize
 
 from . import layout as layout_module
@@ -185,10 +185,7 @@ class ReadDiagram():
 
                 for al in als:
                     if al.reference_name in refs_to_split:
-                        split_als = layout_module.comprehensively_split_alignment(al, self.target_info, 'illumina', 1, 1)
-
-                        seq_bytes = self.target_info.reference_sequence_bytes[al.reference_name]
-                        extended = [sw.extend_alignment(al, seq_bytes) for al in split_als]
+                        extended = layout_module.split_and_extend_alignment(al, self.target_info, 'illumina', 1, 1)
                         all_split_als.extend(extended)
 
                     else: